@@ -8,10 +8,10 @@ The module is presented as a demonstration of web scraping using Python tools
 and the kinds of coding practices that would be needed for a larger, more
 complex application.
 
-The module is limited in scope as the navigation of the pages only matches the
-html tags and class names used on the Sainsbury's site, however it is built
-with multiple functions that could be modified to match a different page
-format or to extract different data from the Sainsbury's pages.
+The navigation of the pages matches the html tags and class names used on the
+Sainsbury's site by default, but these are held in a site profile so that
+other sites with a similar page format can be scraped by loading a profile
+for them.
 
 To run the application type
 python cabinet.py <url>
@@ -22,114 +22,2820 @@ or through another application.
 """
 
 import re
+import os
 import sys
+import time
+import random
+import hashlib
+import email.utils
+import getopt
+import itertools
+import functools
+import collections
+import threading
+import array
+import math
+import csv
+import struct
+import urlparse
+import HTMLParser
+import Queue
+import multiprocessing
+import codecs
+from multiprocessing.pool import ThreadPool, ApplyResult
+from decimal import Decimal
 
 import json
 import requests
+import requests.adapters
+import requests.structures
 import bs4
+try :
+    import brotli
+except ImportError :
+    brotli = None
+try :
+    import pyarrow
+    import pyarrow.parquet
+except ImportError :
+    pyarrow = None
+
+# The price in the text of a pricePerUnit tag. The re is anchored by the
+# requirement for at least 1 digit. It takes the digits with any , and .
+# separators between them, and _price_number decides which separator (if
+# any) is the decimal point and which are thousands separators.
+PRICE_RE = re.compile(u'\\d+(?:[,.]\\d+)*')
+PRICE_SEPARATOR_RE = re.compile(u'[,.]')
+
+# The number of decimal places in a price, so the prices are whole numbers of
+# minor units (pence) when multiplied by 10 ** PRICE_PLACES.
+PRICE_PLACES = 2
+
+# The currency symbols and codes that parse_prices recognises.
+CURRENCIES = {u'£':'GBP', u'$':'USD', u'€':'EUR', u'GBP':'GBP', u'USD':'USD', u'EUR':'EUR'}
+CURRENCY_RE = re.compile(u'[£$€]|\\b(?:GBP|USD|EUR)\\b')
+
+# The unit follows a / , as in £3.50 / unit or £1.20/kg, once any tags have
+# been removed by MARKUP_RE.
+UNIT_RE = re.compile(u'/\\s*([^\\W\\d_]+)', re.UNICODE)
+MARKUP_RE = re.compile(u'<[^<>]*>')
+
+# A structured price: the amount as a Decimal, which is NaN if no price was
+# found, and the currency code and unit, which are None if not found.
+Price = collections.namedtuple('Price', ['amount', 'currency', 'unit'])
+
+def _price_number(match):
+    """ Return the number of a PRICE_RE match as a string with no thousands
+    separators and a decimal point, such as 1234.5, which float and Decimal
+    both take. Every digit after the decimal point is kept, so a price of
+    a fraction of a penny, such as 0.125, stays exact. Returns 'NaN' if
+    there was no match.
+    """
+    if match is None :
+        return 'NaN'
+    text = match.group()
+    groups = PRICE_SEPARATOR_RE.split(text)
+    separators = PRICE_SEPARATOR_RE.findall(text)
+    if not separators or _thousands_separator(groups, separators) :
+        return u''.join(groups)
+    return u''.join(groups[:-1]) + u'.' + groups[-1]
+
+def _thousands_separator(groups, separators):
+    """ Return whether the last of the separators in a price, between the
+    digit groups, is a thousands separator rather than the decimal point.
+    It must be followed by three digits, and then it is taken as thousands
+    if all the separators are the same and there are several of them, as in
+    1,234,567, or if it is a single comma after a group of 1 to 3 digits
+    that does not start with 0, as in 1,234. Otherwise, as in 0,125, 1.459
+    or the comma of 1.234,567, it is the decimal point.
+    """
+    if len(groups[-1]) != 3 or len(set(separators)) > 1 :
+        return False
+    if len(separators) > 1 :
+        return True
+    whole = groups[0]
+    return separators[0] == u',' and len(whole) <= 3 and not whole.startswith(u'0')
+
+def extract_prices(texts):
+    """ Return an array of floats with the price in each of the texts, which
+    are expected to be the contents of pricePerUnit tags, in the same way as
+    extract_price. A text with no price gives NaN (see math.isnan), and
+    nothing is printed for it, so this suits many listing entries at once.
+    """
+    search = PRICE_RE.search
+    return array.array('d', (float(_price_number(search(text) if text else None))
+                             for text in texts))
+
+def parse_prices(texts):
+    """ Return a list of Price tuples for the texts, with the exact amount as
+    a Decimal (NaN if there is no price) and the currency and unit as well.
+    """
+    prices = []
+    for text in texts :
+        if not text :
+            prices.append(Price(Decimal('NaN'), None, None))
+            continue
+        text = MARKUP_RE.sub(u' ', text)
+        currency = CURRENCY_RE.search(text)
+        unit = UNIT_RE.search(text)
+        prices.append(Price(Decimal(_price_number(PRICE_RE.search(text))),
+                            CURRENCIES[currency.group()] if currency else None,
+                            unit.group(1) if unit else None))
+    return prices
+
+def total_price(prices):
+    """ Return the exact total of the prices, which may be Decimals, floats
+    or ints, as a Decimal. A float is taken as the decimal number of its
+    shortest repr, eg 0.1 as Decimal('0.1').
+    Adding Decimals is slow in Python 2 so the prices with no more than
+    PRICE_PLACES decimal places are added as whole numbers of minor units,
+    read from the digits of the Decimal, and only any others are added as
+    Decimals.
+    """
+    minorUnits = 0
+    rest = Decimal(0)
+    for price in prices :
+        if isinstance(price, float) :
+            price = Decimal(repr(price))
+        elif not isinstance(price, Decimal) :
+            price = Decimal(price)
+        exponent = price.as_tuple()[2]
+        if -PRICE_PLACES <= exponent <= 0 :
+            # The string has no exponent, just the digits and any point
+            minorUnits += int(str(price).replace('.', '')) * 10 ** (PRICE_PLACES + exponent)
+        else :
+            rest += price
+    return Decimal(minorUnits).scaleb(-PRICE_PLACES) + rest
+
+class PriceEncoder(json.JSONEncoder):
+    """ A JSONEncoder that writes Decimal prices as JSON numbers. They are
+    written as the shortest repr of the nearest float, which is the exact
+    decimal for prices and totals of up to 15 significant digits.
+    """
+    def default(self, o):
+        if isinstance(o, Decimal) :
+            return float(o)
+        return json.JSONEncoder.default(self, o)
 
 def extract_price(text):
     """ extract the price information from the given text which is expected to
     be the contents of a pricePerUnit tag. This has the price preceded by
     a £ symbol and followed by several <abbr> tags.
     
-    This uses a re to find the digits in the text. The re is anchored by the
+    This uses PRICE_RE to find the digits in the text. The re is anchored by the
     requirement for at least 1 digit. The decimal point (or decimal comma) and 
     digits after the point may be omitted to give some flexibility in case
     the site changes the format slightly.
     
     Returns the price as a float.
     """
-    match = re.search(u'(\d{1,2}[,\.]*\d{0,2})',text)
+    match = PRICE_RE.search(text)
     if match :
-        res = float(match.group())
+        res = float(_price_number(match))
     else :
         print >> sys.stderr, 'Unable to find the price in', text
         res = 0.0
     return res
 
+# The number of linked product pages that may be fetched at the same time.
+DEFAULT_MAX_IN_FLIGHT = 8
+
+# The shared session keeps a pool of keep-alive connections for each of up to
+# POOL_CONNECTIONS hosts, with up to POOL_MAXSIZE connections in each pool.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = DEFAULT_MAX_IN_FLIGHT
+
+_session = None
+_sessionLock = threading.Lock()
+
+# The compressed encodings the pages may be sent in. requests decodes gzip
+# and deflate itself and brotli (br) is decoded by prepare_page, so it is
+# only asked for if the brotli package is installed.
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+
+def _new_session(pool_connections=POOL_CONNECTIONS,
+                 pool_maxsize=POOL_MAXSIZE, host_pool_sizes=None):
+    """ Build a requests session with the given connection pool sizes.
+    """
+    session = requests.Session()
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for host, size in (host_pool_sizes or {}).items() :
+        hostAdapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=size)
+        session.mount('http://%s/' % host, hostAdapter)
+        session.mount('https://%s/' % host, hostAdapter)
+    return session
+
+def configure_session(pool_connections=POOL_CONNECTIONS,
+                      pool_maxsize=POOL_MAXSIZE, host_pool_sizes=None):
+    """ Create the requests session shared by every fetch in this module,
+    replacing (and closing) any existing session.
+    pool_maxsize is the number of keep-alive connections kept for each host.
+    host_pool_sizes is an optional dict mapping a host name to its own pool
+    size, for hosts that need more (or fewer) connections than the rest.
+    Returns the new session.
+    """
+    global _session
+    session = _new_session(pool_connections, pool_maxsize, host_pool_sizes)
+    with _sessionLock :
+        oldSession, _session = _session, session
+    if oldSession is not None :
+        oldSession.close()
+    return session
+
+def get_session():
+    """ Return the shared requests session, creating it with the default pool
+    sizes if configure_session has not been called.
+    """
+    global _session
+    with _sessionLock :
+        if _session is None :
+            _session = _new_session()
+        return _session
+
+# Cached pages younger than CACHE_TTL seconds are used without asking the
+# server, older ones are revalidated with a conditional GET. The least
+# recently used pages are removed once the cache exceeds CACHE_MAX_BYTES.
+CACHE_TTL = 3600
+CACHE_MAX_BYTES = 100 * 1024 * 1024
+
+class ResponseCache(object):
+    """ A persistent cache of web pages held in a directory on disk.
+    Each url is stored as two files named from the sha1 of the url: a .body
+    file with the content of the page and a .json file with the url, the time
+    it was stored, the encoding and the ETag and Last-Modified validators.
+    The modification time of the .body file records when the page was last
+    used and is the order in which pages are evicted. The directory is only
+    listed once, on the first store, and after that the pages and their
+    sizes are kept in least recently used order in entries, with their total
+    in size, so storing a page does not have to look at the whole cache.
+    """
+    def __init__(self, directory, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None
+        self.size = 0
+        if not os.path.isdir(directory) :
+            os.makedirs(directory)
+
+    def _path(self, url, extension):
+        if isinstance(url, unicode) :
+            url = url.encode('utf-8')
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.directory, key + extension)
+
+    def _write(self, path, data):
+        # Write to a temporary file and rename it so that another thread or
+        # process never sees a partly written file.
+        tmpPath = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+        with open(tmpPath, 'wb') as f :
+            f.write(data)
+        try :
+            os.rename(tmpPath, path)
+        except OSError :
+            # Windows will not rename over an existing file.
+            os.remove(path)
+            os.rename(tmpPath, path)
+
+    def lookup(self, url):
+        """ Return (meta, body) for the url, or None if it is not cached.
+        """
+        try :
+            with open(self._path(url, '.json'), 'rb') as f :
+                meta = json.load(f)
+            with open(self._path(url, '.body'), 'rb') as f :
+                body = f.read()
+        except (IOError, OSError, ValueError) :
+            return None
+        if meta.get('url') != url :
+            return None
+        return meta, body
+
+    def is_fresh(self, meta):
+        """ True if the cached page can be used without revalidation.
+        """
+        return time.time() - meta['stored'] < self.ttl
+
+    def conditional_headers(self, meta):
+        """ Return the headers for a conditional GET of the cached page.
+        """
+        headers = {}
+        if meta.get('etag') :
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified') :
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def touch(self, url, meta=None):
+        """ Mark the cached page as recently used. If meta is given it is
+        rewritten with a new stored time, after a successful revalidation.
+        """
+        if meta is not None :
+            meta = dict(meta, stored=time.time())
+            self._write(self._path(url, '.json'), json.dumps(meta))
+        path = self._path(url, '.body')
+        try :
+            os.utime(path, None)
+        except OSError :
+            pass
+        with self.lock :
+            if self.entries is not None and path in self.entries :
+                self.entries[path] = self.entries.pop(path)
+
+    def store(self, url, response):
+        """ Store the page in the requests object response and evict the least
+        recently used pages if the cache is now too big.
+        """
+        meta = {'url':url,
+                'stored':time.time(),
+                'encoding':response.encoding,
+                'etag':response.headers.get('ETag'),
+                'last_modified':response.headers.get('Last-Modified'),
+                'content_type':response.headers.get('Content-Type')}
+        path = self._path(url, '.body')
+        with self.lock :
+            if self.entries is None :
+                self._load()
+        self._write(path, response.content)
+        self._write(self._path(url, '.json'), json.dumps(meta))
+        with self.lock :
+            self.size += len(response.content) - self.entries.pop(path, 0)
+            self.entries[path] = len(response.content)
+        if self.size > self.max_bytes :
+            self.evict()
+
+    def _load(self):
+        # List the pages already in the directory, least recently used first.
+        pages = []
+        for name in os.listdir(self.directory) :
+            if not name.endswith('.body') :
+                continue
+            path = os.path.join(self.directory, name)
+            try :
+                st = os.stat(path)
+            except OSError :
+                continue
+            pages.append((st.st_mtime, path, st.st_size))
+        pages.sort()
+        self.entries = collections.OrderedDict((path, size) for mtime, path, size in pages)
+        self.size = sum(self.entries.values())
+
+    def evict(self):
+        """ Remove the least recently used pages until the cache is no larger
+        than max_bytes.
+        """
+        with self.lock :
+            if self.entries is None :
+                self._load()
+            while self.size > self.max_bytes and self.entries :
+                path, size = self.entries.popitem(last=False)
+                for p in (path, path[:-len('.body')] + '.json') :
+                    try :
+                        os.remove(p)
+                    except OSError :
+                        pass
+                self.size -= size
+
+    def response(self, meta, body):
+        """ Build a requests object for a cached page.
+        """
+        res = requests.Response()
+        res.url = meta['url']
+        res.status_code = 200
+        res._content = body
+        res.encoding = meta.get('encoding')
+        res.headers = requests.structures.CaseInsensitiveDict()
+        for key, header in [('etag','ETag'), ('last_modified','Last-Modified'),
+                            ('content_type','Content-Type')] :
+            if meta.get(key) :
+                res.headers[header] = meta[key]
+        return res
+
+_cache = None
+
+def configure_cache(directory, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+    """ Cache the pages fetched by get_web_page in the given directory.
+    Pass None as the directory to turn the cache off again.
+    Returns the ResponseCache, or None.
+    """
+    global _cache
+    _cache = ResponseCache(directory, ttl, max_bytes) if directory else None
+    return _cache
+
+def url_host(url):
+    """ Return the host (and port, if given) of the url in lower case.
+    """
+    return urlparse.urlsplit(url).netloc.lower()
+
+DEFAULT_PORTS = {'http':80, 'https':443}
+
+def normalize_url(url):
+    """ Return the url in a standard form so that the different ways of
+    writing the same url compare equal: the scheme and host in lower case,
+    no default port, an empty path as /, the query parameters sorted and no
+    fragment.
+    """
+    parts = urlparse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    host, sep, port = netloc.rpartition(':')
+    if sep and ']' not in port and port.isdigit() and DEFAULT_PORTS.get(scheme) == int(port) :
+        netloc = host
+    query = '&'.join(sorted(param for param in parts.query.split('&') if param))
+    return urlparse.urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+# By default the HostLimiter lets each host have HOST_BURST requests at once
+# and then HOST_RATE requests per second, with no more than
+# HOST_MAX_CONCURRENCY requests to the host in progress at the same time.
+HOST_RATE = 5.0
+HOST_BURST = 5
+HOST_MAX_CONCURRENCY = 4
+
+class HostLimiter(object):
+    """ Limits the requests made to each host so that no one site is
+    overloaded. Each host has a token bucket which fills at rate tokens per
+    second up to burst tokens, and a request must take a token before it
+    starts, so the host sees no more than rate requests per second over any
+    length of time. There is also a limit of max_concurrency requests to the
+    host in progress at once. host_rates optionally maps a host name to its
+    own rate. A rate of None means no rate limit.
+    """
+    def __init__(self, rate=HOST_RATE, burst=HOST_BURST,
+                 max_concurrency=HOST_MAX_CONCURRENCY, host_rates=None):
+        self.rate = rate
+        self.burst = burst
+        self.maxConcurrency = max_concurrency
+        self.hostRates = dict(host_rates or {})
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.semaphores = {}
+
+    def _semaphore(self, host):
+        with self.lock :
+            if host not in self.semaphores :
+                self.semaphores[host] = threading.BoundedSemaphore(self.maxConcurrency)
+            return self.semaphores[host]
+
+    def _take_token(self, host):
+        """ Take a token from the host's bucket if there is one and return 0,
+        otherwise return the number of seconds until there will be one.
+        """
+        rate = self.hostRates.get(host, self.rate)
+        if not rate :
+            return 0
+        with self.lock :
+            now = time.time()
+            tokens, last = self.buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * rate)
+            if tokens >= 1 :
+                self.buckets[host] = (tokens - 1, now)
+                return 0
+            self.buckets[host] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def ready(self, host):
+        """ True if a request to the host could start without waiting for a
+        token. This does not take the token.
+        """
+        rate = self.hostRates.get(host, self.rate)
+        with self.lock :
+            if not rate or host not in self.buckets :
+                return True
+            tokens, last = self.buckets[host]
+            return tokens + (time.time() - last) * rate >= 1
+
+    def acquire(self, url):
+        """ Wait until a request to the url's host is allowed and return the
+        host, which must be passed to release when the request is done.
+        """
+        host = url_host(url)
+        self._semaphore(host).acquire()
+        wait = self._take_token(host)
+        while wait :
+            time.sleep(wait)
+            wait = self._take_token(host)
+        return host
+
+    def release(self, host):
+        self._semaphore(host).release()
+
+_limiter = None
+
+def configure_rate_limit(rate=HOST_RATE, burst=HOST_BURST,
+                         max_concurrency=HOST_MAX_CONCURRENCY, host_rates=None):
+    """ Limit the requests get_web_page makes to each host, see HostLimiter.
+    Pass a rate of None and max_concurrency of None to remove the limits.
+    Returns the HostLimiter, or None.
+    """
+    global _limiter
+    if rate is None and max_concurrency is None :
+        _limiter = None
+    else :
+        _limiter = HostLimiter(rate, burst, max_concurrency or sys.maxint, host_rates)
+    return _limiter
+
+class HostQueue(Queue.Queue):
+    """ A queue that hands out items for different hosts in turn rather than
+    first in first out, so that a run over several sites keeps all of them
+    busy instead of working through one site's pages while it is being rate
+    limited. Items for the same host come out in the order they were put in.
+    host is a function giving the host for an item. If a limiter is given a
+    host it would make wait is passed over while another host is ready.
+    """
+    def __init__(self, maxsize=0, host=None, limiter=None):
+        self.host = host
+        self.limiter = limiter
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.hostItems = collections.OrderedDict()
+        self.size = 0
+
+    def _qsize(self, len=len):
+        return self.size
+
+    def _put(self, item):
+        self.hostItems.setdefault(self.host(item), collections.deque()).append(item)
+        self.size += 1
+
+    def _get(self):
+        hosts = list(self.hostItems)
+        chosen = hosts[0]
+        if self.limiter is not None :
+            for host in hosts :
+                if self.limiter.ready(host) :
+                    chosen = host
+                    break
+        items = self.hostItems.pop(chosen)
+        item = items.popleft()
+        if items :
+            # Go to the back of the line behind the other hosts
+            self.hostItems[chosen] = items
+        self.size -= 1
+        return item
+
+# A request that times out, loses its connection or gets one of the
+# RETRY_STATUSES is tried again up to RETRIES more times. Before retry n
+# (counting from 0) it waits a random time of up to RETRY_BACKOFF * 2**n
+# seconds, or the time given by the server's Retry-After header if it sent
+# one, but never more than RETRY_MAX_BACKOFF.
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_MAX_BACKOFF = 30.0
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Seconds to wait for a server to respond before the request times out.
+REQUEST_TIMEOUT = 30
+
+_retries = RETRIES
+_retryBackoff = RETRY_BACKOFF
+_retryMaxBackoff = RETRY_MAX_BACKOFF
+
+def configure_retries(retries=RETRIES, backoff=RETRY_BACKOFF, max_backoff=RETRY_MAX_BACKOFF):
+    """ Set how many times get_web_page retries a failed request and the
+    backoff between retries. A retries of 0 turns retrying off.
+    """
+    global _retries, _retryBackoff, _retryMaxBackoff
+    _retries, _retryBackoff, _retryMaxBackoff = retries, backoff, max_backoff
+
+def retry_delay(attempt, retry_after=None):
+    """ Return the number of seconds to wait before retry number attempt
+    (counting from 0). retry_after is the Retry-After header of the failed
+    response, if any, which is either a number of seconds or an HTTP date.
+    Otherwise the delay is exponential backoff with full jitter: a random
+    time between 0 and the backoff for this attempt, so that many clients
+    that failed together do not all retry together. The delay is never more
+    than the configured max_backoff, so a server asking for a long wait
+    cannot hold up a fetching thread for hours.
+    """
+    if retry_after :
+        retry_after = retry_after.strip()
+        if retry_after.isdigit() :
+            return min(float(retry_after), _retryMaxBackoff)
+        date = email.utils.parsedate_tz(retry_after)
+        if date is not None :
+            return min(max(email.utils.mktime_tz(date) - time.time(), 0), _retryMaxBackoff)
+    return random.uniform(0, min(_retryMaxBackoff, _retryBackoff * 2 ** attempt))
+
+def _request(url, headers):
+    """ Make one GET request for the url through the session, within the
+    rate limit if one is configured.
+    """
+    limiter = _limiter
+    host = limiter.acquire(url) if limiter else None
+    try :
+        return get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    finally :
+        if limiter :
+            limiter.release(host)
+
+# The charset parameter of a Content-Type header, and the charset given by a
+# <meta charset=...> or <meta http-equiv=Content-Type ...> tag.
+HEADER_CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+META_CHARSET_RE = re.compile(r'<meta[^>]+charset\s*=\s*["\']?([\w.:-]+)', re.I)
+
+# Only this much of the start of a page is searched for a <meta> charset.
+CHARSET_SNIFF_BYTES = 2048
+DEFAULT_ENCODING = 'utf-8'
+
+def page_encoding(res):
+    """ Return the character encoding of the body of the requests object:
+    the charset of its Content-Type header, or else the charset of a <meta>
+    tag in the first CHARSET_SNIFF_BYTES bytes of the body, or else utf-8.
+    Unlike requests, this never falls back to ISO-8859-1 for text without a
+    charset or to running chardet over the whole body.
+    """
+    match = HEADER_CHARSET_RE.search(res.headers.get('Content-Type') or '')
+    if not match :
+        match = META_CHARSET_RE.search(res.content[:CHARSET_SNIFF_BYTES])
+    if match :
+        try :
+            return codecs.lookup(match.group(1)).name
+        except LookupError :
+            pass
+    return DEFAULT_ENCODING
+
+def prepare_page(res):
+    """ Make a fetched or cached requests object ready to use: decompress
+    a brotli body, which requests leaves alone, and set its encoding from
+    page_encoding so that res.text is decoded once with that encoding.
+    Returns res.
+    """
+    if brotli and res.headers.get('Content-Encoding', '').lower() == 'br' :
+        res._content = brotli.decompress(res.content)
+        del res.headers['Content-Encoding']
+    res.encoding = page_encoding(res)
+    return res
+
 def get_web_page(url):
     """ Get the web page corresponding to the given url and return a requests
-    object containing the page.
+    object containing the page. The page is fetched through the shared session
+    so connections to the same host are kept alive and reused.
+    If the response cache is configured a fresh cached copy is returned
+    without a request, and a stale one is revalidated with a conditional GET.
+    If a rate limit is configured the request waits until the host's limit
+    allows it.
+    Timeouts, lost connections and responses with status 429 or 5xx are
+    retried with backoff, see retry_delay.
+    The page is asked for compressed and its encoding is set by prepare_page.
     Raise error if the page cannot be retrieved.
     """
-    res=requests.get(url)
+    cache = _cache
+    cached = cache.lookup(url) if cache else None
+    if cached and cache.is_fresh(cached[0]) :
+        cache.touch(url)
+        return prepare_page(cache.response(*cached))
+    headers = cache.conditional_headers(cached[0]) if cached else {}
+    attempt = 0
+    while True :
+        try :
+            res = _request(url, headers)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err :
+            if attempt >= _retries :
+                raise
+            delay = retry_delay(attempt)
+            problem = err
+        else :
+            if res.status_code not in RETRY_STATUSES or attempt >= _retries :
+                break
+            delay = retry_delay(attempt, res.headers.get('Retry-After'))
+            problem = 'status code %d' % res.status_code
+        print >> sys.stderr, 'Retrying web page %s in %.1f seconds after %s' % (url, delay, problem)
+        time.sleep(delay)
+        attempt += 1
+    if res.status_code == 304 and cached :
+        cache.touch(url, cached[0])
+        return prepare_page(cache.response(*cached))
     if res.status_code != 200 :
         print >> sys.stderr, 'Could not load web page %s. Received status code %d' % (url,res.status_code)
         res.raise_for_status()
+    prepare_page(res)
+    if cache :
+        cache.store(url, res)
     return res
 
+def fetch_pages(urls, max_in_flight=DEFAULT_MAX_IN_FLIGHT, pool=None):
+    """ Fetch the web pages for the given urls and yield the requests objects
+    in the same order as the urls, whatever order the fetches complete in.
+    No more than max_in_flight pages are requested at once. If max_in_flight
+    is 1 or less the pages are fetched one after another in the calling thread.
+    pool is an optional ThreadPool to fetch with, so that one pool can be
+    shared by many calls. Otherwise a pool is created for this call.
+    Raise error if any page cannot be retrieved.
+    """
+    if max_in_flight <= 1 :
+        for url in urls :
+            yield get_web_page(url)
+        return
+    ownPool = pool is None
+    if ownPool :
+        pool = ThreadPool(max_in_flight)
+    try :
+        pending = collections.deque()
+        for url in urls :
+            pending.append(pool.apply_async(get_web_page, (url,)))
+            if len(pending) >= max_in_flight :
+                yield pending.popleft().get()
+        while pending :
+            yield pending.popleft().get()
+    finally :
+        if ownPool :
+            pool.terminate()
+
+# The BeautifulSoup tree builders that can parse the pages, fastest first.
+# lxml is much the fastest but is optional as it is harder to install,
+# html.parser is always available and html5lib is the slowest but the most
+# lenient with badly formed html.
+PARSERS = ['lxml', 'html.parser', 'html5lib']
+
+def available_parsers():
+    """ Return the names in PARSERS whose tree builder is installed.
+    """
+    return [name for name in PARSERS
+            if bs4.builder.builder_registry.lookup(name) is not None]
+
+_parser = available_parsers()[0]
+
+def configure_parser(name):
+    """ Use the named tree builder to parse every page. Raise ValueError if
+    the tree builder is not installed.
+    """
+    global _parser
+    if bs4.builder.builder_registry.lookup(name) is None :
+        raise ValueError('Parser %s is not installed. Available parsers are %s'
+                         % (name, ', '.join(available_parsers())))
+    _parser = name
+
+def make_soup(htmlText, parser=None, parse_only=None):
+    """ Parse the html text and return the BeautifulSoup tree. The parser is
+    the configured one unless a tree builder name is given.
+    parse_only is an optional SoupStrainer to build only the matching tags.
+    html5lib does not support this so it is ignored for that parser.
+    """
+    parser = parser or _parser
+    if parser == 'html5lib' :
+        parse_only = None
+    return bs4.BeautifulSoup(htmlText, parser, parse_only=parse_only)
+
+# A single step of a selector: an optional tag name, any number of .class
+# names and an optional :contains(text) test, eg a.productLink or
+# .productDataItemHeader:contains(Description). Text with spaces or
+# brackets in it is quoted, as in :contains("Product (UK) Description").
+SELECTOR_STEP_RE = re.compile(r'^([\w-]*)((?:\.[\w-]+)*)'
+                              r'(?::contains\((?:"([^"]*)"|\'([^\']*)\'|([^()"\']*))\))?$')
+
+# The steps and ~ combinators of a selector are separated by spaces, except
+# for the spaces in quotes.
+SELECTOR_TOKEN_RE = re.compile(r'(?:[^\s"\']|"[^"]*"|\'[^\']*\')+')
+
+class SelectorStep(object):
+    """ One compiled step of a selector, see SELECTOR_STEP_RE. """
+    def __init__(self, text):
+        match = SELECTOR_STEP_RE.match(text)
+        if not match :
+            raise ValueError('Bad selector step %r' % text)
+        name, classes, doubleQuoted, singleQuoted, unquoted = match.groups()
+        self.contains = next((c for c in (doubleQuoted, singleQuoted, unquoted)
+                              if c is not None), None)
+        if not (name or classes or self.contains) :
+            raise ValueError('Bad selector step %r' % text)
+        self.name = name or None
+        self.classes = frozenset(c for c in classes.split('.') if c)
+
+    def match(self, tag):
+        if self.name and tag.name != self.name :
+            return False
+        if self.classes and not self.classes.issubset(tag.get(u'class') or ()) :
+            return False
+        if self.contains is not None and self.contains not in tag.get_text() :
+            return False
+        return True
+
+def compile_selector(selector):
+    """ Compile a selector into a list of (combinator, SelectorStep) pairs.
+    The steps are separated by spaces, meaning the next step is a
+    descendant of the one before, or by ' ~ ', meaning it is a later
+    sibling. The combinator of the first step is None. Spaces inside the
+    quotes of a :contains test do not separate steps.
+    """
+    steps = []
+    combinator = None
+    for text in SELECTOR_TOKEN_RE.findall(selector) :
+        if text == '~' :
+            combinator = '~'
+            continue
+        if steps and combinator is None :
+            combinator = ' '
+        steps.append((combinator, SelectorStep(text)))
+        combinator = None
+    if not steps or combinator is not None :
+        raise ValueError('Bad selector %r' % selector)
+    return steps
+
+def _matches_before(tag, steps, index, root):
+    """ Whether the tag, which matches steps[index], has the relations to
+    the earlier steps that the selector asks for, without leaving root.
+    """
+    if index == 0 :
+        return True
+    combinator = steps[index][0]
+    step = steps[index - 1][1]
+    if combinator == '~' :
+        candidates = tag.find_previous_siblings(True)
+    else :
+        candidates = itertools.takewhile(lambda t : t is not root.parent, tag.parents)
+    for candidate in candidates :
+        if step.match(candidate) and _matches_before(candidate, steps, index - 1, root) :
+            return True
+    return False
+
+class ExtractionPlan(object):
+    """ A compiled set of fields to extract from a tree, evaluated in a
+    single pass over the tree.
+    fields maps each field name to a selector (see compile_selector),
+    optionally followed by @name to take that attribute of the tag or
+    ::html to take the tag's html, rather than its stripped text.
+    The value of a field is taken from the first matching tag. Each tag is
+    only checked against the last step of each selector not yet found, and
+    the earlier steps are checked by looking back up the tree from a tag
+    that matches, so the tree is walked once whatever the number of fields
+    and the walk stops as soon as every field is found.
+    """
+    def __init__(self, fields):
+        self.fields = []
+        for field, spec in sorted(fields.items()) :
+            selector, attribute = spec, None
+            if spec.endswith('::html') :
+                selector, attribute = spec[:-len('::html')], '::html'
+            elif '@' in spec :
+                selector, attribute = spec.rsplit('@', 1)
+            self.fields.append((field, compile_selector(selector), attribute))
+
+    def extract(self, root):
+        """ Return a dict with the value of each field found in the tree
+        below root, and None for the fields not found.
+        """
+        values = dict.fromkeys(field for field, steps, attribute in self.fields)
+        remaining = list(self.fields)
+        for tag in root.descendants :
+            if not isinstance(tag, bs4.Tag) :
+                continue
+            for item in list(remaining) :
+                field, steps, attribute = item
+                if steps[-1][1].match(tag) and _matches_before(tag, steps, len(steps) - 1, root) :
+                    if attribute is None :
+                        values[field] = tag.get_text().strip()
+                    elif attribute == '::html' :
+                        values[field] = unicode(tag)
+                    else :
+                        values[field] = tag.get(attribute)
+                    remaining.remove(item)
+            if not remaining :
+                break
+        return values
+
+# The settings of the built in profile for the Sainsbury's pages.
+# item is the class of the tag around each product on a listing page, and
+# listing the fields taken from that tag for ExtractionPlan. The productInfo
+# tag contains an <a> tag with the href and title string, and its html is the
+# fingerprint of the product in incremental mode.
+# The description is in the description_text tag that follows the
+# description_header tag with the string description_label, and next is the
+# class of the item holding the link to the next listing page.
+SAINSBURYS_PROFILE = {'item':'productInner',
+                      'listing':{'price':'.pricePerUnit',
+                                 'title':'.productInfo a',
+                                 'href':'.productInfo a@href',
+                                 'info':'.productInfo::html'},
+                      'description_header':'productDataItemHeader',
+                      'description_label':'Description',
+                      'description_text':'productText',
+                      'next':'next'}
+
+PROFILE_KEYS = frozenset(SAINSBURYS_PROFILE)
+PROFILE_REQUIRED_KEYS = frozenset(['item', 'listing', 'description_header', 'description_text'])
+PROFILE_LISTING_FIELDS = frozenset(['price', 'title', 'href'])
+
+class SiteProfile(object):
+    """ The class names and selectors used to scrape one site, compiled from
+    a dict of settings like SAINSBURYS_PROFILE. The optional settings,
+    description_label and next, default to those of SAINSBURYS_PROFILE, and
+    the listing fields must include price, title and href.
+    Raises ValueError if the settings are incomplete or a selector is bad.
+    """
+    def __init__(self, name, settings):
+        unknown = set(settings) - PROFILE_KEYS
+        missing = PROFILE_REQUIRED_KEYS - set(settings)
+        if unknown or missing :
+            raise ValueError('Profile %s has unknown settings %s and is missing %s'
+                             % (name, sorted(unknown), sorted(missing)))
+        missing = PROFILE_LISTING_FIELDS - set(settings['listing'])
+        if missing :
+            raise ValueError('Profile %s is missing the listing fields %s' % (name, sorted(missing)))
+        self.name = name
+        self.settings = settings
+        self.item = settings['item']
+        self.next = settings.get('next', SAINSBURYS_PROFILE['next'])
+        self.listing_plan = ExtractionPlan(settings['listing'])
+        header = settings['description_header']
+        text = settings['description_text']
+        self.description_label = settings.get('description_label',
+                                              SAINSBURYS_PROFILE['description_label'])
+        # The label is quoted so that it may have spaces and brackets in it
+        quote = '"' if '"' not in self.description_label else "'"
+        if quote in self.description_label :
+            raise ValueError('Profile %s has a description_label with both kinds of quote' % name)
+        self.description_plan = ExtractionPlan({'description':'.%s:contains(%s%s%s) ~ .%s'
+                                                % (header, quote, self.description_label,
+                                                   quote, text)})
+        # Matches an opening header tag and the text that follows it.
+        self.header_re = re.compile(u'<[^<>]*\\b%s\\b[^<>]*>([^<]*)' % re.escape(header))
+        # The only tags extract_description needs from a product page.
+        self.description_strainer = bs4.SoupStrainer(class_=[header, text])
+
+PROFILES = {'sainsburys':SiteProfile('sainsburys', SAINSBURYS_PROFILE)}
+
+_profile = PROFILES['sainsburys']
+_profileFiles = {}
+
+def load_profiles(path):
+    """ Return a dict of the SiteProfiles, by name, in the JSON file at path,
+    which holds an object mapping each profile name to its settings.
+    The profiles of a file are compiled when it is first loaded and kept
+    for later calls.
+    """
+    profiles = _profileFiles.get(path)
+    if profiles is None :
+        with open(path, 'rb') as f :
+            settings = json.load(f)
+        profiles = dict((name, SiteProfile(name, profileSettings))
+                        for name, profileSettings in settings.items())
+        _profileFiles[path] = profiles
+    return profiles
+
+def configure_profile(name, path=None):
+    """ Scrape the pages with the named site profile, one of PROFILES or of
+    the profiles in the JSON file at path (see load_profiles).
+    Returns the SiteProfile. Raises ValueError if there is no such profile.
+    """
+    global _profile
+    profiles = dict(PROFILES)
+    if path :
+        profiles.update(load_profiles(path))
+    if name not in profiles :
+        raise ValueError('There is no profile %s. The profiles are %s'
+                         % (name, ', '.join(sorted(profiles))))
+    _profile = profiles[name]
+    return _profile
+
+def get_profile():
+    """ Return the SiteProfile in use. """
+    return _profile
+
 def get_outer_tags(htmlText):
     """ This returns a list of class=productInner tags from the given
     text which is expected to be the html of the web page.
     The class=productInner tag contains a productInfo tag with the title and href
     to the linked html and a class=pricePerUnit tag with the pricing.
+    The class is the item class of the site profile.
     """
-    soup = bs4.BeautifulSoup(htmlText,'html5lib')
-    return soup.find_all(class_=u'productInner')
+    soup = make_soup(htmlText)
+    return soup.find_all(class_=_profile.item)
 
 def extract_description(soup):
     """Given the soup extract the product description from it. The description
     is in a div class=productDataItemHeader, but there are multiples of these
     in the document so select the one with string of Description.
     The description text is in a div with class=productText as a sibling of the
-    productDataItemHeader tag.
+    productDataItemHeader tag. Both are found by the description plan of
+    the site profile.
+    Raises ValueError if there is no description.
     """
-    tags = soup.find_all(class_=u'productDataItemHeader')
-    descripionTags = [ t for t in tags if u'Description' in t.string ]
-    # There might be multiple matching tags but we just use the first
-    descriptionTag = descripionTags[0].find_next_sibling(class_=u'productText')
-    description = descriptionTag.text.strip()
+    description = _profile.description_plan.extract(soup)['description']
+    if description is None :
+        raise ValueError('No description found')
     return description
 
+_partialParsing = True
+
+def configure_partial_parsing(enabled):
+    """ Choose whether parse_description parses only the Description block of
+    a product page (the default) or the whole page.
+    """
+    global _partialParsing
+    _partialParsing = enabled
+
+def description_fragment(htmlText):
+    """ Return the part of the page html that runs from the Description
+    productDataItemHeader tag up to the next productDataItemHeader tag, which
+    includes the productText tag holding the description.
+    The html is scanned for header tags rather than parsed and the scan stops
+    at the header after the description. Returns None if there is no
+    Description header.
+    The header class and the Description label are those of the site profile.
+    """
+    profile = _profile
+    matches = profile.header_re.finditer(htmlText)
+    for match in matches :
+        if profile.description_label in match.group(1) :
+            following = next(matches, None)
+            end = following.start() if following else len(htmlText)
+            return htmlText[match.start():end]
+    return None
+
+def parse_description(htmlText, partial=None):
+    """ Return the product description from the html of a product page.
+    With partial parsing only the Description block found by
+    description_fragment is parsed, and only its header and productText tags
+    are built, which is much quicker than building the tree for the whole
+    page. If the fragment cannot be found or does not give a description the
+    whole page is parsed instead. partial defaults to the configured mode.
+    """
+    if partial is None :
+        partial = _partialParsing
+    if partial :
+        fragment = description_fragment(htmlText)
+        if fragment is not None :
+            try :
+                return extract_description(make_soup(fragment, parse_only=_profile.description_strainer))
+            except ValueError :
+                pass
+    return extract_description(make_soup(htmlText))
+
+
+def next_page_url(soup, url):
+    """ Return the url of the next page of a listing, or None if this is the
+    last page. soup is the parsed listing page and url its url, which
+    relative links are resolved against.
+    The link is an <a> or <link> tag with rel=next or, as on the Sainsbury's
+    pages, the <a> tag inside the class=next item of the page list. On the
+    last page that item has no link.
+    """
+    link = soup.find([u'a', u'link'], rel=u'next', href=True)
+    if link is None :
+        nextTag = soup.find(class_=_profile.next)
+        link = nextTag.find(u'a', href=True) if nextTag else None
+    if link is None :
+        return None
+    return urlparse.urljoin(url, link[u'href'])
+
+# The tags that have no end tag, so are never open.
+VOID_TAGS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+                       'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+# The page is fed to a ListingScanner this many characters at a time, and
+# the items found so far are passed on after each.
+LISTING_SCAN_CHUNK = 64 * 1024
+
+class ListingScanner(HTMLParser.HTMLParser):
+    """ Scans the html of a listing page, without building a tree, for the
+    fragments of html that hold the items (the tags with the item class of
+    the site profile) and the link to the next page, which is found in the
+    same way as next_page_url. The fragments found are added to the deque
+    fragments as soon as each item ends.
+    Each fragment is rebuilt from the tags and text the parser reports. The
+    tags that are open are kept on a stack, and an end tag closes the
+    nearest open tag with its name and any left open inside it. An item
+    ends when it is closed in this way, when its parent is closed, or when
+    the next item starts, so an item whose end tag (such as </li>) or inner
+    </div> was left out still ends where a browser would end it.
+    """
+    def __init__(self, profile):
+        HTMLParser.HTMLParser.__init__(self)
+        self.profile = profile
+        self.fragments = collections.deque()
+        self.openTags = []
+        self.parts = None
+        # The position of the open item on openTags
+        self.itemDepth = None
+        self.relNext = None
+        self.classNext = None
+        # The state of the first tag with the next class: None before it,
+        # its position on openTags while inside it and -1 after it.
+        self.nextDepth = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if self.parts is not None and (self.profile.item in classes or
+                                       self._closes_item(tag)) :
+            self._end_item()
+        if self.parts is not None :
+            self.parts.append(self.get_starttag_text())
+        elif self.profile.item in classes :
+            self.parts = [self.get_starttag_text()]
+            self.itemDepth = len(self.openTags)
+        self._find_next(tag, attrs, classes)
+        if tag not in VOID_TAGS :
+            self.openTags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.parts is not None :
+            self.parts.append(self.get_starttag_text())
+        self._find_next(tag, attrs, (attrs.get('class') or '').split())
+
+    def handle_endtag(self, tag):
+        if tag not in self.openTags :
+            # A stray end tag, which closes nothing
+            if self.parts is not None :
+                self.parts.append('</%s>' % tag)
+            return
+        depth = len(self.openTags) - 1 - self.openTags[::-1].index(tag)
+        del self.openTags[depth:]
+        if self.parts is not None :
+            if depth < self.itemDepth :
+                # The parent of the item closed, so the item ended before it
+                self._end_item()
+            else :
+                self.parts.append('</%s>' % tag)
+                if depth == self.itemDepth :
+                    self._end_item()
+        if self.nextDepth is not None and depth <= self.nextDepth :
+            self.nextDepth = -1
+
+    def handle_data(self, data):
+        if self.parts is not None :
+            self.parts.append(data)
+
+    def handle_entityref(self, name):
+        if self.parts is not None :
+            self.parts.append('&%s;' % name)
+
+    def handle_charref(self, name):
+        if self.parts is not None :
+            self.parts.append('&#%s;' % name)
+
+    def close(self):
+        HTMLParser.HTMLParser.close(self)
+        if self.parts is not None :
+            self._end_item()
+
+    def next_url(self, url):
+        """ Return the url of the next page, resolved against url, or None.
+        Only valid once the whole page has been fed.
+        """
+        nextHref = self.relNext or self.classNext
+        return urlparse.urljoin(url, nextHref) if nextHref else None
+
+    def _closes_item(self, tag):
+        # An <li> is ended by the next <li> unless that is in a list inside it
+        return (tag == 'li' and self.openTags[self.itemDepth] == 'li' and
+                not [t for t in self.openTags[self.itemDepth + 1:] if t in ('ul', 'ol')])
+
+    def _end_item(self):
+        self.fragments.append(''.join(self.parts))
+        self.parts = None
+        self.itemDepth = None
+
+    def _find_next(self, tag, attrs, classes):
+        href = attrs.get('href')
+        if (href and self.relNext is None and tag in ('a', 'link') and
+                'next' in (attrs.get('rel') or '').split()) :
+            self.relNext = href
+        if self.nextDepth is None and self.profile.next in classes :
+            self.nextDepth = len(self.openTags) if tag not in VOID_TAGS else -1
+        if (self.nextDepth is not None and self.nextDepth >= 0 and tag == 'a' and
+                href and self.classNext is None) :
+            self.classNext = href
+
+def scan_listing(htmlText, url):
+    """ Scan a listing page with a ListingScanner and return a generator of
+    the html fragments of its items, which yields each as soon as it has
+    been scanned, and a Future for the url of the next page, resolved
+    against url, or None. The Future is finished once the generator is.
+    """
+    nextUrl = Future()
+    return _scan_fragments(htmlText, url, nextUrl), nextUrl
+
+def _scan_fragments(htmlText, url, nextUrl):
+    scanner = ListingScanner(_profile)
+    for start in xrange(0, len(htmlText), LISTING_SCAN_CHUNK) :
+        scanner.feed(htmlText[start:start + LISTING_SCAN_CHUNK])
+        while scanner.fragments :
+            yield scanner.fragments.popleft()
+    scanner.close()
+    while scanner.fragments :
+        yield scanner.fragments.popleft()
+    nextUrl.set_result(scanner.next_url(url))
+
+def fragment_tags(fragments):
+    """ Yield the item tag of each of the html fragments from scan_listing,
+    parsing them one at a time, so only one item's tree need be kept.
+    """
+    item = _profile.item
+    for fragment in fragments :
+        tag = make_soup(fragment).find(class_=item)
+        if tag is not None :
+            yield tag
+
+# Listing pages of at least this many characters are scanned with
+# scan_listing rather than parsed whole, see configure_listing_streaming.
+STREAM_LISTING_SIZE = 1024 * 1024
+
+_streamListingSize = STREAM_LISTING_SIZE
+
+def configure_listing_streaming(size=STREAM_LISTING_SIZE):
+    """ Scan the listing pages of at least size characters for their items
+    one at a time rather than parsing the whole page into a tree. With None
+    every listing page is parsed whole.
+    """
+    global _streamListingSize
+    _streamListingSize = size
+
+def _streamed(htmlText):
+    return _streamListingSize is not None and len(htmlText) >= _streamListingSize
+
+def parse_listing(htmlText, url):
+    """ Parse a listing page once and return its productInner tags (as
+    get_outer_tags) and a Future for the url of the next page (as
+    next_page_url), which is finished once the tags have all been taken.
+    A large page is scanned by scan_listing instead and its tags are
+    parsed one at a time as they are taken, so the tree of the whole page
+    is never built.
+    """
+    nextUrl = Future()
+    if _streamed(htmlText) :
+        return _streamed_tags(htmlText, url, nextUrl), nextUrl
+    soup = make_soup(htmlText)
+    nextUrl.set_result(next_page_url(soup, url))
+    return soup.find_all(class_=_profile.item), nextUrl
+
+def _streamed_tags(htmlText, url, nextUrl):
+    fragments, scannedUrl = scan_listing(htmlText, url)
+    found = False
+    for tag in fragment_tags(fragments) :
+        found = True
+        yield tag
+    if not found and _profile.item in htmlText :
+        # The scan could not make out the items, so parse the page whole
+        soup = make_soup(htmlText)
+        nextUrl.set_result(next_page_url(soup, url))
+        for tag in soup.find_all(class_=_profile.item) :
+            yield tag
+    else :
+        nextUrl.set_result(scannedUrl.result())
+
+def product_items(tags):
+    """ Yield a (dict, url) pair for each of the productInner tags, where
+    the dict has the unit_price, currency, unit and title taken from the tag
+    and url is the href of the linked page with the rest of the information.
+    The fields of each tag are taken together by the listing plan of the
+    site profile and the prices by parse_prices, so unit_price is an exact
+    Decimal. The prices of a list of tags, from a page parsed whole, are
+    parsed in one batch. The tags of a scanned page are taken one at a time
+    and each pair is yielded as soon as its tag has been taken.
+    """
+    plan = _profile.listing_plan
+    if isinstance(tags, list) :
+        batches = [tags]
+    else :
+        batches = ([tag] for tag in tags)
+    for batch in batches :
+        extracted = [plan.extract(tag) for tag in batch]
+        prices = parse_prices([fields['price'] for fields in extracted])
+        for fields, price in itertools.izip(extracted, prices) :
+            yield _product_item(fields, price)
+
+def _product_item(fields, price):
+    pageDict = {}
+    if price.amount.is_nan() :
+        print >> sys.stderr, 'Unable to find the price in', fields['price']
+        pageDict['unit_price'] = Decimal(0)
+    else :
+        pageDict['unit_price'] = price.amount
+    pageDict['currency'] = price.currency
+    pageDict['unit'] = price.unit
+    pageDict['title'] = fields['title']
+    url = fields['href']
+    state = _state
+    if state is not None :
+        state.note_listing(url, fingerprint(fields.get('info') or url + pageDict['title']))
+    return pageDict, url
+
+def listing_items(text):
+    """ Yield a (dict, url) pair for each productInner tag on the page, see
+    product_items. A large page is scanned as in parse_listing.
+    """
+    if _streamed(text) :
+        return product_items(parse_listing(text, '')[0])
+    return product_items(get_outer_tags(text))
+
+def page_details(htmlText, size=None):
+    """ Return a dict with the description and size of a product page from
+    its html. size is the number of bytes in the page as it was fetched,
+    which defaults to the length of the html.
+    """
+    if size is None :
+        size = len(htmlText)
+    return {'description':parse_description(htmlText),
+            'size':'%5.1fKb' % (size/1024.0)}
+
+_parsePool = None
+_parseWorkers = 0
+
+def _init_parse_worker(parser, partialParsing, profileName, profileSettings):
+    """ Give a parse worker process the parser settings and site profile of
+    the main process, as they are not inherited where processes are not
+    forked (Windows).
+    """
+    global _profile
+    configure_parser(parser)
+    configure_partial_parsing(partialParsing)
+    _profile = SiteProfile(profileName, profileSettings)
+
+def configure_parse_pool(workers):
+    """ Parse the product pages in a pool of this many worker processes, so
+    that parsing uses more than one core. The html of each page is sent to a
+    worker and only the description and size come back. With 0 workers the
+    pages are parsed in this process, which is the default.
+    The workers take the current parser settings and site profile so this
+    should be called after configure_parser, configure_partial_parsing and
+    configure_profile.
+    """
+    global _parsePool, _parseWorkers
+    oldPool = _parsePool
+    _parsePool = None
+    _parseWorkers = workers
+    if workers > 0 :
+        _parsePool = multiprocessing.Pool(workers, _init_parse_worker,
+                                          (_parser, _partialParsing,
+                                           _profile.name, _profile.settings))
+    if oldPool is not None :
+        oldPool.terminate()
+
+# Journals of completed products are kept in this directory, in a file
+# named from the job id, which must match JOB_ID_RE.
+JOURNAL_DIR = 'cabinet-jobs'
+JOB_ID_RE = re.compile(r'^[\w.-]+$')
+
+class Journal(object):
+    """ A checkpoint journal on disk for a scrape job, recording the url and
+    extracted details of each product as soon as it has been scraped, so that
+    if the job is interrupted a rerun can skip the products already done.
+    The file has a line of JSON for each product. A line left incomplete by
+    an interruption is ignored when the journal is read back, and cut off
+    so that the next record starts on a line of its own.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path) :
+            with open(path, 'r+b') as f :
+                end = 0
+                for line in f :
+                    if not line.endswith('\n') :
+                        break
+                    end += len(line)
+                    try :
+                        record = json.loads(line)
+                    except ValueError :
+                        continue
+                    self.done[record['url']] = record['details']
+                f.truncate(end)
+        self.file = open(path, 'ab')
+
+    def get(self, url):
+        """ Return the details recorded for the product url, or None.
+        """
+        with self.lock :
+            return self.done.get(url)
+
+    def record(self, url, details):
+        """ Record the details of a product and write them to disk.
+        """
+        line = json.dumps({'url':url, 'details':details}, sort_keys=True)
+        with self.lock :
+            self.done[url] = details
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        with self.lock :
+            self.file.close()
+
+_journal = None
+
+def configure_journal(job, directory=JOURNAL_DIR):
+    """ Record the products scraped in the journal for the named job, in the
+    given directory, and skip any products already recorded there by an
+    earlier run of the job. Pass None as the job to stop using a journal.
+    Returns the Journal, or None.
+    """
+    global _journal
+    if _journal is not None :
+        _journal.close()
+    _journal = None
+    if job :
+        if not JOB_ID_RE.match(job) :
+            raise ValueError('The job id %s may only have letters, digits, _, . and -' % job)
+        if not os.path.isdir(directory) :
+            os.makedirs(directory)
+        _journal = Journal(os.path.join(directory, job + '.journal'))
+    return _journal
+
+def fingerprint(text):
+    """ Return the sha1 hex digest of the text, to tell whether it has
+    changed since an earlier run.
+    """
+    if isinstance(text, unicode) :
+        text = text.encode('utf-8')
+    return hashlib.sha1(text).hexdigest()
+
+class ProductState(object):
+    """ The state kept between runs in incremental mode: for each product url
+    the fingerprint of its entry on the listing page, the fingerprint of its
+    linked page and the details taken from that page.
+    The listing fingerprint is of the productInfo tag, which holds the title
+    and link but not the price, so a change of price alone does not make the
+    product page be fetched again. If the listing entry is unchanged the
+    stored details are used without fetching the product page, and if the
+    product page is fetched but is unchanged it is not parsed again.
+    The state is held in memory and written to a JSON file by save.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.products = {}
+        self.listings = {}
+        if os.path.exists(path) :
+            with open(path, 'rb') as f :
+                self.products = json.load(f)
+
+    def note_listing(self, url, listingFingerprint):
+        """ Note the fingerprint of the product's listing entry in this run.
+        """
+        with self.lock :
+            self.listings[url] = listingFingerprint
+
+    def unchanged(self, url):
+        """ Return the stored details of the product if its listing entry has
+        not changed since they were stored, otherwise None.
+        """
+        with self.lock :
+            product = self.products.get(url)
+            if product and product['listing'] == self.listings.get(url) :
+                return product['details']
+        return None
+
+    def page_unchanged(self, url, pageFingerprint):
+        """ Return the stored details of the product if its page has not
+        changed since they were stored, otherwise None.
+        """
+        with self.lock :
+            product = self.products.get(url)
+            if product and product['page'] == pageFingerprint :
+                return product['details']
+        return None
+
+    def record(self, url, pageFingerprint, details):
+        with self.lock :
+            self.products[url] = {'listing':self.listings.get(url),
+                                  'page':pageFingerprint,
+                                  'details':details}
+
+    def save(self):
+        """ Write the state to its file, replacing the file in one step so an
+        interruption cannot leave it half written.
+        """
+        with self.lock :
+            data = json.dumps(self.products, sort_keys=True)
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'wb') as f :
+            f.write(data)
+        if os.path.exists(self.path) :
+            os.remove(self.path)
+        os.rename(tmpPath, self.path)
+
+_state = None
+
+def configure_incremental(path):
+    """ Run in incremental mode with the state kept in the file at path, or
+    with None save the state and leave incremental mode.
+    Returns the ProductState, or None.
+    """
+    global _state
+    if _state is not None :
+        _state.save()
+    _state = ProductState(path) if path else None
+    return _state
+
+def _known_details(url):
+    """ Return the details of a product that need not be scraped: those in
+    the journal of the job, or in incremental mode those stored with an
+    unchanged listing entry. Otherwise None.
+    """
+    journal, state = _journal, _state
+    details = journal.get(url) if journal else None
+    if details is None and state is not None :
+        details = state.unchanged(url)
+    return details
+
+def _record_details(url, pageFingerprint, details):
+    """ Record the details of a product that has been scraped in the journal
+    and the incremental state, as they are configured.
+    """
+    journal, state = _journal, _state
+    if journal :
+        journal.record(url, details)
+    if state is not None :
+        state.record(url, pageFingerprint, details)
+
+class DedupeTable(object):
+    """ The products of a run by normalised url (see normalize_url), so that
+    a product that is listed more than once, on one listing or on several,
+    is only fetched and parsed once.
+    The first scrape to claim a url fetches and parses it and sets the
+    details on the url's Future, and any other claim of the url is given
+    the same Future to wait for, even while the first is still in flight.
+    A claim that is given up, because the product could not be scraped, is
+    removed so that a later claim tries again.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+        self.duplicates = 0
+
+    def claim(self, url):
+        """ Return a (future, owner) pair for the url, where owner is True
+        if the caller must scrape the product and set the details on the
+        future, and False if it should wait for the future.
+        """
+        key = normalize_url(url)
+        with self.lock :
+            future = self.futures.get(key)
+            if future is not None :
+                self.duplicates += 1
+                return future, False
+            future = self.futures[key] = Future()
+            return future, True
+
+    def release(self, url, future, excInfo):
+        """ Give up a claim, finishing the future with the sys.exc_info()
+        tuple excInfo.
+        """
+        key = normalize_url(url)
+        with self.lock :
+            if self.futures.get(key) is future :
+                del self.futures[key]
+        future.set_exception(excInfo)
+
+_dedupe = None
+
+def configure_dedupe(enabled):
+    """ Start a new DedupeTable shared by all the scrapes until it is turned
+    off, or with False go back to each scrape having its own table.
+    Returns the table, or None.
+    """
+    global _dedupe
+    _dedupe = DedupeTable() if enabled else None
+    return _dedupe
+
+def _iter_scrape_items(items, max_in_flight, pool, table=None):
+    """ Fetch the linked page for each (dict, url) pair in items and yield
+    the dicts completed with the description and size, in order.
+    If there is a parse pool, up to two pages per worker are handed to it at
+    a time and fetching carries on while they are parsed.
+    Products in the journal, or unchanged in incremental mode, are not
+    fetched again (see _known_details) and the rest are recorded as they are
+    completed. A product already claimed in the DedupeTable is not fetched
+    but takes the details from the claim, if the claim has finished or was
+    made by this scrape, which completes its items in order. A claim that
+    another scrape still has in flight is not waited for, as that scrape may
+    be consumed by this same thread, so the product is fetched here as well.
+    table defaults to the one configured for the run, or else a new one.
+    """
+    if table is None :
+        table = _dedupe or DedupeTable()
+    claims = []
+    ownClaims = set()
+    def known(url) :
+        """ Return the details, or a Future for them, if the product need not
+        be fetched, otherwise None and the Future for its claim (if any).
+        """
+        details = _known_details(url)
+        if details is not None :
+            return details, None
+        future, owner = table.claim(url)
+        if not owner :
+            if future.done() or future in ownClaims :
+                return future, None
+            return None, None
+        claims.append((url, future))
+        ownClaims.add(future)
+        return None, future
+    # Decide once for each item whether it is already known, as the journal
+    # changes while the pages are being fetched.
+    items = ((pageDict, url) + known(url) for pageDict, url in items)
+    items, urlItems = itertools.tee(items)
+    # Follow the links to get the info from the linked html
+    pages = fetch_pages((url for pageDict, url, details, claim in urlItems if details is None),
+                        max_in_flight, pool)
+    parsePool = _parsePool
+    state = _state
+    window = 2 * _parseWorkers if parsePool is not None else 0
+    def complete(pageDict, url, details, pageFingerprint, claim) :
+        if isinstance(details, ApplyResult) :
+            details = details.get()
+        elif isinstance(details, Future) :
+            details = details.result()
+        if pageFingerprint is not None :
+            _record_details(url, pageFingerprint, details)
+        if claim is not None :
+            claim.set_result(details)
+        pageDict.update(details)
+        return pageDict
+    try :
+        pending = collections.deque()
+        for pageDict, url, details, claim in items :
+            if details is not None :
+                pending.append((pageDict, url, details, None, None))
+                continue
+            page = next(pages)
+            pageFingerprint = fingerprint(page.content)
+            details = state.page_unchanged(url, pageFingerprint) if state is not None else None
+            if details is None and parsePool is not None :
+                details = parsePool.apply_async(page_details, (page.text, len(page.content)))
+            elif details is None :
+                details = page_details(page.text, len(page.content))
+            pending.append((pageDict, url, details, pageFingerprint, claim))
+            while len(pending) > window :
+                yield complete(*pending.popleft())
+        while pending :
+            yield complete(*pending.popleft())
+    finally :
+        pages.close()
+        # Give up the claims of the products not completed, so that any
+        # other scrape waiting for them is not left waiting for ever.
+        for url, claim in claims :
+            if not claim.done() :
+                err = RuntimeError('The scrape of %s did not finish' % url)
+                table.release(url, claim, (RuntimeError, err, None))
+
+def iter_scrape_page(text, max_in_flight=DEFAULT_MAX_IN_FLIGHT, pool=None):
+    """ Scrape the given page yielding a dict with the results for each item
+    found on the page, in the same order as the items on the page.
+    Each dict is yielded as soon as its linked page has been fetched and
+    parsed, while the following pages (up to max_in_flight of them) are still
+    being fetched, so the caller can start work on the first results straight
+    away. If the caller stops early, by closing the generator or dropping it,
+    the outstanding fetches are abandoned.
+    pool is an optional ThreadPool shared with other calls, see fetch_pages.
+    """
+    return _iter_scrape_items(listing_items(text), max_in_flight, pool)
 
-def scrape_page(text):
+def iter_scrape_listing(url, max_in_flight=DEFAULT_MAX_IN_FLIGHT, pool=None,
+                        max_pages=1):
+    """ Fetch the listing page at url and scrape it as iter_scrape_page,
+    then follow its next page links, up to max_pages pages in all (None for
+    no limit), yielding the results of every page in order.
+    While the products of one page are being fetched the next listing page
+    is fetched alongside them, so it is ready as soon as they are done.
+    Raise error if a listing page cannot be retrieved.
+    """
+    ownPool = pool is None and max_in_flight > 1
+    if ownPool :
+        pool = ThreadPool(max_in_flight)
+    table = _dedupe or DedupeTable()
+    try :
+        seen = set([url])
+        page = get_web_page(url)
+        pageCount = 1
+        while page is not None :
+            tags, nextUrl = parse_listing(page.text, url)
+            def follow(nextUrl, pageCount=pageCount) :
+                if nextUrl in seen or (max_pages is not None and pageCount >= max_pages) :
+                    return None, None
+                return nextUrl, pool.apply_async(get_web_page, (nextUrl,)) if pool else None
+            # The next url of a large page is only known once its items have
+            # been scanned, so the next page is fetched from then on.
+            following = nextUrl.then(follow)
+            for pageDict in _iter_scrape_items(product_items(tags), max_in_flight, pool, table) :
+                yield pageDict
+            nextUrl, prefetch = following.result()
+            if nextUrl :
+                page = prefetch.get() if prefetch else get_web_page(nextUrl)
+                url = nextUrl
+                seen.add(url)
+                pageCount += 1
+            else :
+                page = None
+    finally :
+        if ownPool :
+            pool.terminate()
+
+def scrape_page(text, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
     """ Scrape the given page returning a list of dicts where each dict
     has the results of the items found on the page.
+    The linked pages are fetched concurrently, up to max_in_flight at a time,
+    but the list is in the same order as the items on the page.
+    This collects the results of iter_scrape_page into a list.
     """
-    res=[]
-    for tag in get_outer_tags(text) :
-        pageDict = {}
-        pageDict['unit_price'] = extract_price(tag.find(class_='pricePerUnit').text)
-        # The class=productInfo tag contains an <a> tag with the href and title string.
-        innerTag = tag.find(class_=u'productInfo')
-        pageDict['title'] = innerTag.a.text.strip()
-        url = innerTag.a[u'href']
-        # Follow the link to get the info from the linked html
-        page = get_web_page(url)
-        soup = bs4.BeautifulSoup(page.text,'html5lib')
-        pageDict['description'] = extract_description(soup)
-        pageDict['size'] = '%5.1fKb' % (len(page.text)/1024.0)
+    return list(iter_scrape_page(text, max_in_flight))
+
+class Future(object):
+    """ The result of an operation, such as one started by the AsyncEngine,
+    which may not have finished yet. Callbacks added with add_done_callback
+    are called with the Future once it has finished, in the thread that
+    finished it, so they must be quick and must not wait for other Futures.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._callbacks = []
+        self._result = None
+        self._excInfo = None
+
+    def _finish(self, result, excInfo):
+        with self._lock :
+            if self._event.is_set() :
+                return
+            self._result, self._excInfo = result, excInfo
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks :
+            callback(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, excInfo):
+        """ Finish with an error. excInfo is the sys.exc_info() tuple so the
+        original traceback is kept.
+        """
+        self._finish(None, excInfo)
+
+    def done(self):
+        return self._event.is_set()
+
+    def exception(self):
+        """ Return the exception the operation raised, or None. Only valid
+        once the Future is done.
+        """
+        return self._excInfo[1] if self._excInfo else None
+
+    def result(self, timeout=None):
+        """ Wait for the operation to finish and return its result, or raise
+        the error it raised. Raise RuntimeError if it does not finish within
+        timeout seconds.
+        """
+        if not self._event.wait(timeout) :
+            raise RuntimeError('Operation did not finish within %s seconds' % timeout)
+        if self._excInfo :
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+        return self._result
+
+    def add_done_callback(self, callback):
+        with self._lock :
+            if not self._event.is_set() :
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def then(self, func):
+        """ Return a new Future for func applied to the result of this one.
+        If func returns a Future the new Future finishes when that one does.
+        Errors are passed on without calling func.
+        """
+        chained = Future()
+        def onDone(future) :
+            if future._excInfo :
+                chained.set_exception(future._excInfo)
+                return
+            try :
+                res = func(future._result)
+            except Exception :
+                chained.set_exception(sys.exc_info())
+                return
+            if isinstance(res, Future) :
+                res.add_done_callback(lambda f : chained._finish(f._result, f._excInfo))
+            else :
+                chained.set_result(res)
+        self.add_done_callback(onDone)
+        return chained
+
+# The asynchronous engine has a fixed number of threads for fetching pages
+# and for parsing them, shared by every scrape however many are running.
+ASYNC_FETCH_THREADS = 32
+ASYNC_PARSE_THREADS = 4
+
+class AsyncEngine(object):
+    """ An asynchronous equivalent of get_web_page, scrape_page and scrape
+    whose methods return a Future straight away instead of blocking.
+    No thread is tied up waiting for a scrape: pages are fetched by a pool of
+    fetch_threads threads and parsed by a separate pool of parse_threads
+    threads, and each step starts the next from a callback. So any number of
+    scrapes can be in progress at once and the fetching threads are never
+    held up by BeautifulSoup.
+    """
+    def __init__(self, fetch_threads=ASYNC_FETCH_THREADS, parse_threads=ASYNC_PARSE_THREADS):
+        self.fetchPool = ThreadPool(fetch_threads)
+        self.parsePool = ThreadPool(parse_threads)
+
+    def _submit(self, pool, func, *args):
+        future = Future()
+        def run() :
+            try :
+                future.set_result(func(*args))
+            except Exception :
+                future.set_exception(sys.exc_info())
+        pool.apply_async(run)
+        return future
+
+    def close(self):
+        """ Stop the pools. Operations still in progress never finish.
+        """
+        self.fetchPool.terminate()
+        self.parsePool.terminate()
+
+    def get_web_page(self, url):
+        """ Return a Future for the requests object of the page at url, see
+        get_web_page.
+        """
+        return self._submit(self.fetchPool, lambda : get_web_page(url))
+
+    def scrape_page(self, text):
+        """ Return a Future for the list of dicts that scrape_page would
+        return for the html text of a listing page.
+        """
+        return self._submit(self.parsePool, lambda : list(listing_items(text))).then(self._scrape_items)
+
+    def _scrape_items(self, items):
+        """ Fetch and parse the linked page for each (dict, url) pair and
+        return a Future for the list of completed dicts, in order.
+        Each url is claimed in the DedupeTable configured for the run (or a
+        new one for this call), so a product is only fetched once however
+        many scrapes list it at the same time. Nothing waits for a claim, as
+        the dict is completed from a callback on it.
+        """
+        future = Future()
+        if not items :
+            future.set_result([])
+            return future
+        table = _dedupe or DedupeTable()
+        lock = threading.Lock()
+        remaining = [len(items)]
+        def settle(url, claim, details) :
+            if details._excInfo :
+                table.release(url, claim, details._excInfo)
+            else :
+                claim.set_result(details._result)
+        def onDetails(pageDict, detailsFuture) :
+            try :
+                pageDict.update(detailsFuture.result())
+            except Exception :
+                future.set_exception(sys.exc_info())
+                return
+            with lock :
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+            if finished :
+                future.set_result([pageDict for pageDict, url in items])
+        for pageDict, url in items :
+            claim, owner = table.claim(url)
+            if owner :
+                details = self.get_web_page(url).then(
+                    lambda page : self._submit(self.parsePool, page_details,
+                                               page.text, len(page.content)))
+                details.add_done_callback(functools.partial(settle, url, claim))
+            claim.add_done_callback(functools.partial(onDetails, pageDict))
+        return future
+
+    def scrape(self, url):
+        """ Return a Future for the dict of results and total that scrape
+        prints for the listing page at url.
+        """
+        def total(results) :
+            return {'results':results, 'total':total_price(d['unit_price'] for d in results)}
+        return self.get_web_page(url).then(lambda page : self.scrape_page(page.text)).then(total)
+
+_engine = None
+_engineLock = threading.Lock()
+
+def get_async_engine():
+    """ Return the shared AsyncEngine, creating it the first time.
+    """
+    global _engine
+    with _engineLock :
+        if _engine is None :
+            _engine = AsyncEngine()
+        return _engine
+
+def get_web_page_async(url):
+    """ Asynchronous get_web_page. Returns a Future for the requests object.
+    """
+    return get_async_engine().get_web_page(url)
+
+def scrape_page_async(text):
+    """ Asynchronous scrape_page. Returns a Future for the list of dicts.
+    """
+    return get_async_engine().scrape_page(text)
+
+def scrape_async(url):
+    """ Asynchronous scrape of the listing page at url. Returns a Future for
+    the dict of results and total.
+    """
+    return get_async_engine().scrape(url)
+
+# The default number of threads in the listing and parse stages of the
+# Pipeline and the number of items each queue between the stages can hold.
+PIPELINE_LISTING_WORKERS = 2
+PIPELINE_PARSE_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 32
+
+class Pipeline(object):
+    """ Scrapes listings as a pipeline of separate stages, each with its own
+    threads, connected by queues:
+
+    listing fetch -> link extraction -> product fetch -> parse -> emit
 
-        res.append(pageDict)
+    The listing stage fetches listing pages, the extraction stage (a single
+    thread, as it is quick) parses them for the product items and next page
+    link, which goes back to the listing stage, the product fetch stage
+    fetches the linked pages and the parse stage extracts their description
+    and size, through the parse pool if configure_parse_pool has been called.
+    The emit stage, in run, puts the results back into order. A product that
+    is listed more than once is only fetched and parsed once (see
+    DedupeTable).
+    The queue to the product fetch stage is a HostQueue, so when several
+    sites are being scraped their pages are fetched in turn and a site that
+    is held back by the rate limit does not hold up the others.
+    The queues between the stages hold at most queue_size items, so a stage
+    that gets ahead waits for the next one to catch up (and the whole
+    pipeline waits if the caller of run stops taking results). So the number
+    of fetching threads and the parsing capacity can be tuned separately.
+    Only one run may be in progress at a time.
+    """
+    def __init__(self, listing_workers=PIPELINE_LISTING_WORKERS,
+                 fetch_workers=DEFAULT_MAX_IN_FLIGHT,
+                 parse_workers=PIPELINE_PARSE_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        self.listingWorkers = listing_workers
+        self.fetchWorkers = fetch_workers
+        self.parseWorkers = parse_workers
+        self.queueSize = queue_size
+
+    def _put(self, queue, item):
+        # Wait for room in the queue, but give up if the run is stopped.
+        while not self._stop.is_set() :
+            try :
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full :
+                pass
+
+    def _worker(self, queue, stage):
+        """ Run the stage function on each item from the queue until the run
+        is stopped. Errors are passed to the emit stage to be raised there.
+        """
+        while not self._stop.is_set() :
+            try :
+                item = queue.get(timeout=0.1)
+            except Queue.Empty :
+                continue
+            try :
+                stage(item)
+            except Exception :
+                self._put(self._emitQueue, ('error', sys.exc_info()))
+
+    def _fetch_listing(self, item):
+        listingIndex, pageNumber, url = item
+        try :
+            page = get_web_page(url)
+        except requests.exceptions.RequestException :
+            self._put(self._emitQueue, ('failed', listingIndex, sys.exc_info()))
+            return
+        self._put(self._extractQueue, (listingIndex, pageNumber, url, page.text))
+
+    def _extract_links(self, item):
+        listingIndex, pageNumber, url, text = item
+        tags, nextUrl = parse_listing(text, url)
+        items = list(product_items(tags))
+        nextUrl = nextUrl.result()
+        seen = self._seen.setdefault(listingIndex, set())
+        seen.add(url)
+        if nextUrl in seen or (self._maxPages is not None and pageNumber + 1 >= self._maxPages) :
+            nextUrl = None
+        if nextUrl :
+            self._listingQueue.put((listingIndex, pageNumber + 1, nextUrl))
+        self._put(self._emitQueue, ('page', (listingIndex, pageNumber), len(items), nextUrl is None))
+        for itemIndex, (pageDict, productUrl) in enumerate(items) :
+            key = (listingIndex, pageNumber, itemIndex)
+            known = _known_details(productUrl)
+            if known is not None :
+                # Already scraped by an earlier run
+                pageDict.update(known)
+                self._put(self._emitQueue, ('item', key, pageDict))
+                continue
+            claim, owner = self._table.claim(productUrl)
+            if owner :
+                self._put(self._fetchQueue, (key, pageDict, productUrl, claim))
+            else :
+                # Listed more than once, so wait for the first to be parsed
+                claim.add_done_callback(functools.partial(self._emit_duplicate, key, pageDict))
+
+    def _emit_duplicate(self, key, pageDict, claim):
+        try :
+            pageDict.update(claim.result())
+        except requests.exceptions.RequestException :
+            self._put(self._emitQueue, ('failed', key[0], sys.exc_info()))
+            return
+        except Exception :
+            self._put(self._emitQueue, ('error', sys.exc_info()))
+            return
+        self._put(self._emitQueue, ('item', key, pageDict))
+
+    def _fetch_product(self, item):
+        key, pageDict, url, claim = item
+        try :
+            page = get_web_page(url)
+        except requests.exceptions.RequestException :
+            excInfo = sys.exc_info()
+            # Let a later claim of the url try again
+            self._table.release(url, claim, excInfo)
+            self._put(self._emitQueue, ('failed', key[0], excInfo))
+            return
+        self._put(self._parseQueue, (key, pageDict, url, page.content, page.text, claim))
+
+    def _parse_product(self, item):
+        key, pageDict, url, content, text, claim = item
+        pageFingerprint = fingerprint(content)
+        state = _state
+        details = state.page_unchanged(url, pageFingerprint) if state is not None else None
+        parsePool = _parsePool
+        if details is None and parsePool is not None :
+            details = parsePool.apply(page_details, (text, len(content)))
+        elif details is None :
+            details = page_details(text, len(content))
+        _record_details(url, pageFingerprint, details)
+        pageDict.update(details)
+        self._put(self._emitQueue, ('item', key, pageDict))
+        claim.set_result(details)
+
+    def run(self, urls, max_pages=1):
+        """ Scrape the listings at urls, following up to max_pages pages of
+        each (None for no limit), and yield a (url, dict) pair for each
+        product in the same order as scraping them one after another.
+        A listing with a listing or product page that cannot be fetched is
+        reported on stderr and left out, and the other listings are still
+        scraped. Any other error stops the run and is raised.
+        When the run ends, or the caller closes the generator, the stage
+        threads are stopped and waited for.
+        """
+        for message in self._run(urls, max_pages) :
+            if message[0] == 'item' :
+                yield message[1:]
+            elif message[0] == 'failed' :
+                print >> sys.stderr, 'Could not scrape %s. %s' % (message[1], message[2][1])
+
+    def listings(self, urls, max_pages=1):
+        """ Scrape the listings at urls as run does, but yield a (url, items)
+        pair for each listing, in order, where items is a generator of its
+        dicts. Iterating items raises the RequestException of a listing that
+        could not be scraped, and a listing with no products gives no items.
+        Any items of a listing the caller does not take are passed over.
+        """
+        messages = self._run(urls, max_pages)
+        try :
+            for url in urls :
+                items = self._listing_items(messages)
+                yield url, items
+                try :
+                    for item in items :
+                        pass
+                except requests.exceptions.RequestException :
+                    pass
+        finally :
+            messages.close()
+
+    def _listing_items(self, messages):
+        for message in messages :
+            if message[0] == 'item' :
+                yield message[2]
+            elif message[0] == 'failed' :
+                excInfo = message[2]
+                raise excInfo[0], excInfo[1], excInfo[2]
+            else :
+                return
+
+    def _run(self, urls, max_pages):
+        """ Run the stages and yield the messages of the emit stage, see
+        _emit.
+        """
+        urls = list(urls)
+        self._stop = threading.Event()
+        self._maxPages = max_pages
+        self._seen = {}
+        self._table = _dedupe or DedupeTable()
+        # The listing queue is not bounded as the extraction stage puts next
+        # pages back on it. It is a priority queue so that the next page of an
+        # early listing is fetched before the later listings.
+        self._listingQueue = Queue.PriorityQueue()
+        self._extractQueue = Queue.Queue(self.queueSize)
+        # Product pages are handed to the fetchers for each host in turn
+        self._fetchQueue = HostQueue(self.queueSize, lambda item : url_host(item[2]), _limiter)
+        self._parseQueue = Queue.Queue(self.queueSize)
+        self._emitQueue = Queue.Queue(self.queueSize)
+        for listingIndex, url in enumerate(urls) :
+            self._listingQueue.put((listingIndex, 0, url))
+        stages = [(self._listingQueue, self._fetch_listing, self.listingWorkers),
+                  (self._extractQueue, self._extract_links, 1),
+                  (self._fetchQueue, self._fetch_product, self.fetchWorkers),
+                  (self._parseQueue, self._parse_product, self.parseWorkers)]
+        threads = []
+        for queue, stage, workers in stages :
+            for i in range(max(workers, 1)) :
+                thread = threading.Thread(target=self._worker, args=(queue, stage))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+        try :
+            for message in self._emit(urls) :
+                yield message
+        finally :
+            # Wait for the stages to finish the item each has in hand, so
+            # nothing is still being fetched once the run is over.
+            self._stop.set()
+            for thread in threads :
+                thread.join()
+
+    def _emit(self, urls):
+        """ The emit stage. Take the results from the emit queue and yield
+        them in order, as ('item', url, dict) messages, each listing ending
+        with an ('end', url) message, or with ('failed', url, excInfo) if one
+        of its pages could not be fetched, in which case the rest of the
+        listing is dropped.
+        A ('page', key, count, last) message on the queue gives the number of
+        items on a listing page and whether it is the last page of its
+        listing, and a ('failed', listingIndex, excInfo) message the first
+        error of a listing.
+        """
+        counts = {}
+        buffered = {}
+        failed = {}
+        listingIndex, pageNumber, itemIndex = 0, 0, 0
+        while listingIndex < len(urls) :
+            url = urls[listingIndex]
+            if listingIndex in failed :
+                yield 'failed', url, failed[listingIndex]
+                for key in [key for key in buffered if key[0] == listingIndex] :
+                    del buffered[key]
+                listingIndex, pageNumber, itemIndex = listingIndex + 1, 0, 0
+                continue
+            key = (listingIndex, pageNumber, itemIndex)
+            if key in buffered :
+                yield 'item', url, buffered.pop(key)
+                itemIndex += 1
+                continue
+            pageKey = (listingIndex, pageNumber)
+            if pageKey in counts and itemIndex >= counts[pageKey][0] :
+                count, last = counts.pop(pageKey)
+                if last :
+                    yield 'end', url
+                    listingIndex, pageNumber, itemIndex = listingIndex + 1, 0, 0
+                else :
+                    pageNumber, itemIndex = pageNumber + 1, 0
+                continue
+            message = self._emitQueue.get()
+            if message[0] == 'error' :
+                excInfo = message[1]
+                raise excInfo[0], excInfo[1], excInfo[2]
+            elif message[0] == 'failed' :
+                failed.setdefault(message[1], message[2])
+            elif message[1][0] < listingIndex or message[1][0] in failed :
+                # Part of a listing that has been dropped
+                continue
+            elif message[0] == 'page' :
+                counts[message[1]] = message[2:]
+            else :
+                buffered[message[1]] = message[2]
+
+# The fields of a scraped product, in the order of the CSV columns.
+PRODUCT_FIELDS = ('title', 'unit_price', 'currency', 'unit', 'description', 'size')
+
+class Product(object):
+    """ A compact record of one scraped product, with a slot for each of
+    PRODUCT_FIELDS rather than a dict, for holding many products in memory.
+    """
+    __slots__ = PRODUCT_FIELDS
+
+    def __init__(self, title=None, unit_price=None, currency=None, unit=None,
+                 description=None, size=None):
+        self.title = title
+        self.unit_price = unit_price
+        self.currency = currency
+        self.unit = unit
+        self.description = description
+        self.size = size
+
+    @classmethod
+    def from_dict(cls, d):
+        """ Make a Product from a result dict. Other keys are left out. """
+        return cls(*[d.get(field) for field in PRODUCT_FIELDS])
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in PRODUCT_FIELDS)
+
+    def __eq__(self, other):
+        return isinstance(other, Product) and self.as_dict() == other.as_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Product(%s)' % ', '.join('%s=%r' % (field, getattr(self, field))
+                                         for field in PRODUCT_FIELDS)
+
+def price_minor_units(price):
+    """ Return the price as a whole number of minor units (pence), see
+    PRICE_PLACES. Raises ValueError if it has more decimal places.
+    """
+    if isinstance(price, float) :
+        price = Decimal(repr(price))
+    minorUnits = Decimal(price).scaleb(PRICE_PLACES)
+    if minorUnits != minorUnits.to_integral_value() :
+        raise ValueError('The price %s has more than %d decimal places' % (price, PRICE_PLACES))
+    return int(minorUnits)
+
+class CodedColumn(object):
+    """ A column of a ProductTable with few distinct values, such as the
+    currency, kept as an array of small codes into a list of the values.
+    """
+    def __init__(self):
+        self.values = []
+        self.codes = array.array('H')
+        self._index = {}
+
+    def append(self, value):
+        code = self._index.get(value)
+        if code is None :
+            code = self._index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+    def __len__(self):
+        return len(self.codes)
+
+class ProductTable(object):
+    """ A columnar container of products: a list of each of the text fields,
+    the prices as an array of minor units, the sizes as an array of floats
+    in Kb and the currency and unit as CodedColumns. This takes much less
+    memory than a list of dicts and the total is just the sum of an array.
+    The few prices that are not a whole number of minor units, such as
+    0.125 a kg, have 0 in the array and are kept exactly, by row, in the
+    dict exactPrices.
+    Products are added as result dicts or Products and are given back as
+    Products.
+    """
+    def __init__(self, products=()):
+        self.titles = []
+        self.descriptions = []
+        self.prices = array.array('l')
+        self.exactPrices = {}
+        self.sizes = array.array('d')
+        self.currencies = CodedColumn()
+        self.units = CodedColumn()
+        self.extend(products)
+
+    def append(self, product):
+        if isinstance(product, Product) :
+            product = product.as_dict()
+        self.titles.append(product.get('title'))
+        price = product.get('unit_price') or 0
+        try :
+            self.prices.append(price_minor_units(price))
+        except ValueError :
+            self.exactPrices[len(self.prices)] = Decimal(repr(price) if isinstance(price, float)
+                                                         else price)
+            self.prices.append(0)
+        self.currencies.append(product.get('currency'))
+        self.units.append(product.get('unit'))
+        self.descriptions.append(product.get('description'))
+        size = product.get('size')
+        # The size is formatted as in page_details, eg '  2.0Kb'
+        self.sizes.append(float(size[:-2]) if size else float('nan'))
+
+    def extend(self, products):
+        for product in products :
+            self.append(product)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __getitem__(self, i):
+        size = self.sizes[i]
+        return Product(self.titles[i], self.price(i), self.currencies[i],
+                       self.units[i], self.descriptions[i],
+                       None if math.isnan(size) else '%5.1fKb' % size)
+
+    def __iter__(self):
+        for i in xrange(len(self)) :
+            yield self[i]
+
+    def price(self, i):
+        """ Return the exact price of row i as a Decimal. """
+        if i < 0 :
+            i += len(self)
+        exact = self.exactPrices.get(i)
+        return exact if exact is not None else Decimal(self.prices[i]).scaleb(-PRICE_PLACES)
+
+    def total(self):
+        """ Return the exact total of the prices as a Decimal. """
+        return Decimal(sum(self.prices)).scaleb(-PRICE_PLACES) + sum(self.exactPrices.values())
+
+    def write_csv(self, out):
+        """ Write the products to the file out as CSV with a header row of
+        PRODUCT_FIELDS. Text is written as utf-8.
+        """
+        writer = csv.writer(out)
+        writer.writerow(PRODUCT_FIELDS)
+        for product in self :
+            writer.writerow(_csv_row(product.as_dict()))
+
+    def write_parquet(self, path):
+        """ Write the products to a Parquet file at path, with the prices as
+        decimals and the sizes in Kb. This needs the optional pyarrow package.
+        """
+        if pyarrow is None :
+            raise ImportError('Writing Parquet files needs the pyarrow package')
+        places = max([PRICE_PLACES] + [-price.as_tuple().exponent
+                                       for price in self.exactPrices.values()])
+        columns = [pyarrow.array(self.titles, pyarrow.string()),
+                   pyarrow.array([self.price(i) for i in xrange(len(self))],
+                                 pyarrow.decimal128(18, places)),
+                   pyarrow.array([self.currencies[i] for i in xrange(len(self))], pyarrow.string()),
+                   pyarrow.array([self.units[i] for i in xrange(len(self))], pyarrow.string()),
+                   pyarrow.array(self.descriptions, pyarrow.string()),
+                   pyarrow.array(self.sizes, pyarrow.float64())]
+        pyarrow.parquet.write_table(pyarrow.Table.from_arrays(columns, list(PRODUCT_FIELDS)), path)
+
+    def write_columnar(self, out, url=None):
+        """ Write the table to the file out as a block of a simple binary
+        columnar format: a header of COLUMNAR_MAGIC, the number of rows and
+        the url (if given), then each column in turn. Numbers are little
+        endian, the prices are 8 byte integers of minor units and the sizes
+        8 byte floats, the currency and unit columns are their list of values
+        then a 2 byte code for each row, and the text columns are a 4 byte
+        length for each row (-1 for None) then the utf-8 text of them all.
+        The prices are followed by the exact prices: their number, their
+        rows as 4 byte integers and then their text.
+        """
+        rows = len(self)
+        out.write(struct.pack('<4sI', COLUMNAR_MAGIC, rows))
+        _write_strings(out, [url])
+        _write_strings(out, self.titles)
+        out.write(struct.pack('<%dq' % rows, *self.prices))
+        exactRows = sorted(self.exactPrices)
+        out.write(struct.pack('<I%dI' % len(exactRows), len(exactRows), *exactRows))
+        _write_strings(out, [str(self.exactPrices[row]) for row in exactRows])
+        for column in (self.currencies, self.units) :
+            out.write(struct.pack('<H', len(column.values)))
+            _write_strings(out, column.values)
+            out.write(struct.pack('<%dH' % rows, *column.codes))
+        _write_strings(out, self.descriptions)
+        out.write(struct.pack('<%dd' % rows, *self.sizes))
+
+    @classmethod
+    def read_columnar(cls, f):
+        """ Read a block written by write_columnar from the file f and return
+        a (url, ProductTable) pair, or None at the end of the file.
+        """
+        header = f.read(8)
+        if not header :
+            return None
+        magic, rows = struct.unpack('<4sI', header)
+        if magic != COLUMNAR_MAGIC :
+            raise ValueError('Not a columnar block')
+        table = cls()
+        url = _read_strings(f, 1)[0]
+        table.titles = _read_strings(f, rows)
+        table.prices = array.array('l', _read_struct(f, '<%dq' % rows))
+        count = _read_struct(f, '<I')[0]
+        exactRows = _read_struct(f, '<%dI' % count)
+        table.exactPrices = dict(zip(exactRows, (Decimal(price) for price in _read_strings(f, count))))
+        for column in (table.currencies, table.units) :
+            count = _read_struct(f, '<H')[0]
+            column.values = _read_strings(f, count)
+            column._index = dict((value, code) for code, value in enumerate(column.values))
+            column.codes = array.array('H', _read_struct(f, '<%dH' % rows))
+        table.descriptions = _read_strings(f, rows)
+        table.sizes = array.array('d', _read_struct(f, '<%dd' % rows))
+        return url, table
+
+# The first bytes of each block written by ProductTable.write_columnar.
+COLUMNAR_MAGIC = 'CABT'
+
+def _write_strings(out, values):
+    values = [None if value is None else
+              value.encode('utf-8') if isinstance(value, unicode) else value
+              for value in values]
+    out.write(struct.pack('<%di' % len(values), *[-1 if value is None else len(value)
+                                                   for value in values]))
+    out.write(''.join(value for value in values if value is not None))
+
+def _read_struct(f, fmt):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size :
+        raise ValueError('The columnar block is cut short')
+    return struct.unpack(fmt, data)
+
+def _read_strings(f, count):
+    lengths = _read_struct(f, '<%di' % count)
+    data = f.read(sum(length for length in lengths if length > 0))
+    values = []
+    start = 0
+    for length in lengths :
+        if length < 0 :
+            values.append(None)
+        else :
+            values.append(data[start:start + length].decode('utf-8'))
+            start += length
+    return values
+
+def _csv_value(value):
+    if value is None :
+        return ''
+    if isinstance(value, unicode) :
+        return value.encode('utf-8')
+    return str(value)
+
+def write_json(results, out, url=None):
+    """ Write the results and their total to the file out as a single
+    indented JSON object. If the url of the listing is given it is included
+    in the object. Returns the JSON text.
+    """
+    results = list(results)
+    total = total_price( [d['unit_price'] for d in results ] )
+    listing = {'results':results, 'total':total}
+    if url is not None :
+        listing['url'] = url
+    res = json.dumps(listing, sort_keys=True, indent=4, cls=PriceEncoder)
+    out.write(res + '\n')
+    return res
+
+def write_ndjson(results, out, url=None):
+    """ Write the results to the file out as newline delimited JSON, one
+    object per line written as soon as each result is available, followed by
+    a {"total": ...} record. Nothing is kept in memory except the running
+    total. If the url of the listing is given it is added to every record as
+    "listing". Returns the text of the total record.
+    """
+    def prices() :
+        for d in results :
+            price = d['unit_price']
+            if url is not None :
+                d = dict(d, listing=url)
+            out.write(json.dumps(d, sort_keys=True, cls=PriceEncoder) + '\n')
+            out.flush()
+            yield price
+    record = {'total':total_price(prices())}
+    if url is not None :
+        record['listing'] = url
+    res = json.dumps(record, sort_keys=True, cls=PriceEncoder)
+    out.write(res + '\n')
+    out.flush()
+    return res
+
+def write_compact_json(results, out, url=None):
+    """ Write the results and their total to the file out as write_json
+    does, but as compact JSON with no indentation or spaces, which is
+    quicker to write and smaller. Returns the JSON text.
+    """
+    results = list(results)
+    listing = {'results':results, 'total':total_price([d['unit_price'] for d in results])}
+    if url is not None :
+        listing['url'] = url
+    res = json.dumps(listing, sort_keys=True, separators=(',', ':'), cls=PriceEncoder)
+    out.write(res + '\n')
     return res
 
+def _csv_row(d, url=None):
+    row = [_csv_value(d.get(field)) for field in PRODUCT_FIELDS]
+    if url is not None :
+        row.append(_csv_value(url))
+    return row
+
+# The header of the CSV written by write_csv for the listings of a batch,
+# which have a listing column.
+CSV_BATCH_HEADER = ','.join(PRODUCT_FIELDS + ('listing',)) + '\r\n'
+
+def write_csv(results, out, url=None):
+    """ Write the results to the file out as CSV, a row written as soon as
+    each result is available, with the columns of PRODUCT_FIELDS. If the url
+    of the listing is given it is added to every row as a listing column and
+    the header row is left to the caller, so that the listings of a batch
+    share one header (CSV_BATCH_HEADER). Returns the total of the prices.
+    """
+    writer = csv.writer(out)
+    if url is None :
+        writer.writerow(PRODUCT_FIELDS)
+    def prices() :
+        for d in results :
+            writer.writerow(_csv_row(d, url))
+            yield d['unit_price']
+    return total_price(prices())
+
+def write_columnar(results, out, url=None):
+    """ Write the results to the file out as a block of the binary columnar
+    format (see ProductTable.write_columnar), with the url of the listing if
+    it is given. Returns the total of the prices.
+    """
+    table = ProductTable(results)
+    table.write_columnar(out, url)
+    return table.total()
+
+def read_columnar(f):
+    """ Yield a (url, ProductTable) pair for each block in the file f
+    written by write_columnar, where url is None if it was not given.
+    """
+    while True :
+        block = ProductTable.read_columnar(f)
+        if block is None :
+            return
+        yield block
+
+# The output formats of scrape and their writer functions, which all take
+# the results, the file to write to and optionally the url of the listing.
+WRITERS = {'json':write_json, 'compact':write_compact_json, 'ndjson':write_ndjson,
+           'csv':write_csv, 'columnar':write_columnar}
+
+# The text written before, between and after the listings of a batch for
+# the writers that need it.
+BATCH_FRAMING = {write_json:('[\n', ',\n', ']\n'),
+                 write_compact_json:('[', ',', ']\n'),
+                 write_csv:(CSV_BATCH_HEADER, '', '')}
+
+def read_urls(args, urlFile=None):
+    """ Return the list of urls from the command line arguments followed by
+    those in the file named urlFile, one per line, if it is given. A urlFile
+    of - reads the urls from stdin. Blank lines and lines starting with #
+    are ignored.
+    """
+    urls = list(args)
+    if urlFile :
+        f = sys.stdin if urlFile == '-' else open(urlFile)
+        try :
+            for line in f :
+                line = line.strip()
+                if line and not line.startswith('#') :
+                    urls.append(line)
+        finally :
+            if f is not sys.stdin :
+                f.close()
+    return urls
+
 usage = \
 """
-You must provide a URL as the single command line argument, for example,
+You must provide a URL as the command line argument, for example,
 cabinet.py http://hiring-tests.s3-website-eu-west-1.amazonaws.com/2015_Developer_Scrape/5_products.html
 
+Several URLs may be given, or read from a file, and they are all scraped in
+one run. The results for each are then given separately with their URL.
+
+Options (given before the URLs):
+  --urls=FILE   also scrape the URLs listed in FILE, one per line, or read
+                them from stdin if FILE is -
+  --pages=N     follow the next page links of each listing, scraping up to
+                N pages, or every page with --pages=all (default 1)
+  --workers=N   fetch up to N linked pages at the same time (default %d)
+  --cache=DIR   keep fetched pages in DIR and revalidate them on later runs
+  --cache-ttl=S use cached pages younger than S seconds without asking the
+                server (default %d)
+  --parser=NAME parse pages with NAME, one of %s (default %s)
+  --profile=NAME
+                scrape the pages with the site profile NAME, one of %s
+                or a profile in the --profiles file (default sainsburys)
+  --profiles=FILE
+                load site profiles from the JSON file FILE
+  --full-parse  parse the whole of each product page rather than just the
+                Description block
+  --parse-workers=N
+                parse the product pages in N worker processes (default 0,
+                parse them in the main process)
+  --retries=N   retry a page up to N times after a timeout, lost connection
+                or status 429 or 5xx, with backoff (default %d)
+  --rate=R      make no more than R requests a second to any one site
+  --host-connections=N
+                make no more than N requests to any one site at once
+  --job=ID      record each product in a journal for the job ID as it is
+                scraped, and skip the products already recorded by an
+                earlier, interrupted, run of the same job
+  --journal-dir=DIR
+                keep the job journals in DIR (default %s)
+  --state=FILE  run incrementally, keeping in FILE what was scraped from each
+                product page and only fetching the pages whose listing entry
+                has changed (a change of price alone is taken from the
+                listing) and only parsing those pages that have changed
+  --pipeline    run listing fetching, link extraction, product fetching and
+                parsing as separate stages connected by queues
+  --listing-workers=N
+                with --pipeline, fetch up to N listing pages at the same
+                time (default %d)
+  --queue-size=N
+                with --pipeline, let each queue between the stages hold up
+                to N items (default %d)
+  --format=FMT  write the results as FMT, one of json (indented JSON, the
+                default), compact (JSON without indentation), ndjson (a line
+                of JSON for each result as soon as it is scraped, followed
+                by a line with the total), csv or columnar (binary columns,
+                see ProductTable.write_columnar)
+  --ndjson      the same as --format=ndjson
+  --output=FILE write the results to FILE rather than stdout
+
 The results will be printed to stdout so you can pipe them to a file 
 or another programme.
-"""
+""" % (DEFAULT_MAX_IN_FLIGHT, CACHE_TTL, ', '.join(PARSERS), _parser,
+       ', '.join(sorted(PROFILES)), RETRIES,
+       JOURNAL_DIR, PIPELINE_LISTING_WORKERS, PIPELINE_QUEUE_SIZE)
 
-def scrape(argv) :
+def _settings():
+    """ Return the module settings that the options of scrape change, so
+    that _restore_settings can put them back once the run is over.
+    """
+    return (_cache, _limiter, _parser, _partialParsing, _profile,
+            _retries, _retryBackoff, _retryMaxBackoff)
+
+def _restore_settings(settings):
+    global _cache, _limiter, _parser, _partialParsing, _profile
+    global _retries, _retryBackoff, _retryMaxBackoff
+    (_cache, _limiter, _parser, _partialParsing, _profile,
+     _retries, _retryBackoff, _retryMaxBackoff) = settings
+
+def scrape(argv, out=None) :
     """ Top level function to take the command line argument and call.
     scrape_page. This exists to allow scrape_page to be reused without it
     depending on the command line or to allow scrape_page to be called 
     with a sequence of different pages.
+    The results are written to out, which defaults to stdout.
+    The settings the options change (the cache, rate limits, parser, site
+    profile and retries) are put back as they were once the run is over, so
+    later calls of the module's functions are not affected by the run.
     """
-    if len(argv) == 1 or 'help' in argv[1] or 'http' not in argv[1]:
+    settings = _settings()
+    try :
+        return _scrape(argv, out)
+    finally :
+        _restore_settings(settings)
+
+def _scrape(argv, out) :
+    try :
+        opts, args = getopt.getopt(argv[1:], '', ['workers=', 'cache=',
+                                                    'cache-ttl=', 'parser=', 'full-parse',
+                                                    'profile=', 'profiles=',
+                                                    'ndjson', 'urls=', 'pages=',
+                                                    'parse-workers=', 'pipeline',
+                                                    'listing-workers=', 'queue-size=',
+                                                    'rate=', 'host-connections=', 'retries=',
+                                                    'job=', 'journal-dir=', 'state=',
+                                                    'format=', 'output=', 'help'])
+        options = dict(opts)
+        urls = read_urls(args, options.get('--urls'))
+        maxInFlight = int(options.get('--workers', DEFAULT_MAX_IN_FLIGHT))
+        cacheTtl = float(options.get('--cache-ttl', CACHE_TTL))
+        maxPages = options.get('--pages', '1')
+        maxPages = None if maxPages == 'all' else int(maxPages)
+        if '--full-parse' in options :
+            configure_partial_parsing(False)
+        if '--parser' in options :
+            configure_parser(options['--parser'])
+        if '--profile' in options or '--profiles' in options :
+            configure_profile(options.get('--profile', 'sainsburys'), options.get('--profiles'))
+        parseWorkers = int(options.get('--parse-workers', 0))
+        rate = float(options['--rate']) if '--rate' in options else None
+        retries = int(options.get('--retries', RETRIES))
+        hostConnections = int(options['--host-connections']) if '--host-connections' in options else None
+        outputFormat = 'ndjson' if '--ndjson' in options else options.get('--format', 'json')
+        if outputFormat not in WRITERS :
+            raise ValueError('The format must be one of %s' % ', '.join(sorted(WRITERS)))
+        if '--job' in options and not JOB_ID_RE.match(options['--job']) :
+            raise ValueError('The job id may only have letters, digits, _, . and -')
+        if '--pipeline' in options :
+            pipeline = Pipeline(int(options.get('--listing-workers', PIPELINE_LISTING_WORKERS)),
+                                maxInFlight, max(parseWorkers, PIPELINE_PARSE_WORKERS),
+                                int(options.get('--queue-size', PIPELINE_QUEUE_SIZE)))
+    except (getopt.GetoptError, ValueError, IOError) as err :
+        print >> sys.stderr, err
+        options, urls = {}, []
+    if (not urls or '--help' in options or 'help' in urls[0] or
+            [url for url in urls if 'http' not in url]) :
         print >> sys.stderr, usage
         res = usage
     else :
-        page = get_web_page(argv[1])
-        results = scrape_page( page.text )
-        total = sum( [d['unit_price'] for d in results ] )
-        res = json.dumps({'results':results, 'total':total}, sort_keys=True, indent=4)
-        print res
+        outFile = open(options['--output'], 'wb') if '--output' in options else None
+        out = outFile or out or sys.stdout
+        # Keep a connection alive for each page that may be in flight.
+        configure_session(pool_maxsize=max(maxInFlight, 1))
+        if '--cache' in options :
+            configure_cache(options['--cache'], cacheTtl)
+        if parseWorkers :
+            configure_parse_pool(parseWorkers)
+        configure_retries(retries)
+        if '--job' in options :
+            configure_journal(options['--job'], options.get('--journal-dir', JOURNAL_DIR))
+        if '--state' in options :
+            configure_incremental(options['--state'])
+        if rate or hostConnections :
+            configure_rate_limit(rate, max(int(rate or 0), 1), hostConnections)
+        writer = WRITERS[outputFormat]
+        # Each product is only scraped once in the run
+        configure_dedupe(True)
+        try :
+            if '--pipeline' in options :
+                res = scrape_pipeline(pipeline, urls, writer, out, maxPages)
+            elif len(urls) == 1 :
+                res = writer(iter_scrape_listing(urls[0], maxInFlight, max_pages=maxPages), out)
+            else :
+                res = scrape_batch(urls, writer, out, maxInFlight, maxPages)
+        finally :
+            if parseWorkers :
+                configure_parse_pool(0)
+            if '--job' in options :
+                configure_journal(None)
+            if '--state' in options :
+                configure_incremental(None)
+            configure_dedupe(False)
+            if outFile :
+                outFile.close()
     return res # for unit test
 
+def scrape_pipeline(pipeline, urls, writer, out, max_pages=1):
+    """ Scrape the listings in urls with the Pipeline and write the results
+    to out using the writer function, in the same form as scrape_batch (or
+    as a single listing if there is only one url). A listing that cannot be
+    scraped is reported on stderr and the rest are still scraped.
+    Returns a list of what the writer returned for each listing.
+    """
+    res = []
+    batch = len(urls) > 1
+    framing = BATCH_FRAMING.get(writer) if batch else None
+    if framing :
+        out.write(framing[0])
+    for url, results in pipeline.listings(urls, max_pages) :
+        try :
+            if framing :
+                # Collect the results first so a failure leaves no partial listing
+                results = list(results)
+                if res :
+                    out.write(framing[1])
+            res.append(writer(results, out, url) if batch else writer(results, out))
+        except requests.exceptions.RequestException as err :
+            print >> sys.stderr, 'Could not scrape %s. %s' % (url, err)
+    if framing :
+        out.write(framing[2])
+    return res if batch else (res[0] if res else writer([], out))
+
+def scrape_batch(urls, writer, out, max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_pages=1):
+    """ Scrape every listing in urls in this one process and write the
+    results of each, with its url, to out using the writer function. Up to
+    max_pages pages of each listing are scraped, see iter_scrape_listing. The
+    listings share the session, the cache and one pool of fetching threads.
+    JSON output is written as an array of the listings and CSV output with
+    one header row, see BATCH_FRAMING. A listing that cannot be scraped is
+    reported on stderr and the rest are still scraped.
+    If the listings are on more than one host they are scraped together by
+    a Pipeline instead, which fetches the hosts' pages in turn (see
+    HostQueue) rather than one listing after another.
+    Returns a list of what the writer returned for each listing.
+    """
+    if len(set(url_host(url) for url in urls)) > 1 :
+        return scrape_pipeline(Pipeline(fetch_workers=max(max_in_flight, 1)),
+                               urls, writer, out, max_pages)
+    res = []
+    pool = ThreadPool(max_in_flight) if max_in_flight > 1 else None
+    framing = BATCH_FRAMING.get(writer)
+    if framing :
+        out.write(framing[0])
+    try :
+        for url in urls :
+            try :
+                results = iter_scrape_listing(url, max_in_flight, pool, max_pages)
+                if framing :
+                    # Collect the results first so a failure leaves no partial listing
+                    results = list(results)
+                    if res :
+                        out.write(framing[1])
+                res.append(writer(results, out, url))
+            except requests.exceptions.RequestException as err :
+                print >> sys.stderr, 'Could not scrape %s. %s' % (url, err)
+    finally :
+        if pool is not None :
+            pool.terminate()
+    if framing :
+        out.write(framing[2])
+    return res
+
 if __name__ == '__main__' :
     scrape(sys.argv)
     
@@ -7,9 +7,20 @@ at the command line.
 """
 import unittest
 import types
+import os
+import math
+import time
+import random
+import threading
+import shutil
+import tempfile
+import StringIO
+import csv
 
 import requests
+import requests.adapters
 import json
+from decimal import Decimal
 import bs4
 
 import cabinet
@@ -34,6 +45,63 @@ class TestCabinet(unittest.TestCase):
             res = cabinet.extract_price(tc[0])
             self.assertEqual(res,tc[1],msg='Failed with %s' % tc[0])
 
+    def test_normalize_url_gives_standard_form(self):
+        self.assertEqual( cabinet.normalize_url('HTTPS://Shop.Example.com:443?b=2&a=1#top'),
+                          'https://shop.example.com/?a=1&b=2' )
+        self.assertEqual( cabinet.normalize_url('http://example.com:8080/Pear'),
+                          'http://example.com:8080/Pear' )
+
+    def test_dedupe_table_gives_claim_to_first(self):
+        table = cabinet.DedupeTable()
+        future, owner = table.claim('http://example.com/a')
+        self.assertTrue( owner )
+        duplicate, owner = table.claim('http://EXAMPLE.com/a')
+        self.assertFalse( owner )
+        self.assertIs( duplicate, future )
+        table.release('http://example.com/a', future, (RuntimeError, RuntimeError('x'), None))
+        self.assertRaises(RuntimeError, duplicate.result, 0)
+        self.assertTrue( table.claim('http://example.com/a')[1] )
+        self.assertEqual( table.duplicates, 1 )
+
+    def test_extract_prices_matches_extract_price(self):
+        texts = [tc[0] for tc in PRICE_NUMBERS_DATA] + PRICE_CONTENTS_DATA
+        res = cabinet.extract_prices(texts)
+        self.assertEqual( res.typecode, 'd' )
+        self.assertEqual( list(res), [cabinet.extract_price(text) for text in texts] )
+
+    def test_extract_prices_gives_nan_for_missing_price(self):
+        res = cabinet.extract_prices([u'£1.50', u'no price', None, u'£.'])
+        self.assertEqual( res[0], 1.5 )
+        self.assertTrue( all(math.isnan(price) for price in res[1:]) )
+
+    def test_parse_prices_gives_currency_and_unit(self):
+        res = cabinet.parse_prices([PRICE_CONTENTS_DATA[3], u'€2.10/kg', u'1.00 GBP / each', u'£4'])
+        self.assertEqual( res, [(Decimal('3.50'), 'USD', u'unit'), (Decimal('2.10'), 'EUR', u'kg'),
+                                (Decimal('1.00'), 'GBP', u'each'), (Decimal('4'), 'GBP', None)] )
+
+    def test_prices_handle_decimal_comma_and_thousands(self):
+        texts = [u'£3,50', u'1.234,56 €', u'£1,234.56', u'£1,234', u'£12,5', u'£93.',
+                 u'£0.125/kg', u'£1.459 / litre', u'£3.505', u'£0,125', u'£1,234,567',
+                 u'1.234.567 €', u'£1234,567']
+        expected = ['3.50', '1234.56', '1234.56', '1234', '12.5', '93',
+                    '0.125', '1.459', '3.505', '0.125', '1234567',
+                    '1234567', '1234.567']
+        res = [price.amount for price in cabinet.parse_prices(texts)]
+        self.assertEqual( [str(amount) for amount in res], expected )
+        self.assertEqual( cabinet.extract_price(u'£3,50'), 3.5 )
+        self.assertEqual( cabinet.extract_price(u'£0.125/kg'), 0.125 )
+        self.assertEqual( list(cabinet.extract_prices([u'£1.459 / litre', u'£3.505'])),
+                          [1.459, 3.505] )
+
+    def test_total_price_is_exact(self):
+        prices = [Decimal('0.10')] * 100000 + [0.1, 2, Decimal('0.001')]
+        self.assertEqual( cabinet.total_price(prices), Decimal('10002.101') )
+        self.assertEqual( cabinet.total_price([]), 0 )
+
+    def test_price_encoder_writes_decimals_as_numbers(self):
+        res = json.dumps({'total':Decimal('10000.10')}, cls=cabinet.PriceEncoder)
+        self.assertEqual( res, '{"total": 10000.1}' )
+
     def test_get_web_page_succeeds(self):
         res = cabinet.get_web_page(u'http://www.python.org/')
         self.assertEqual(res.status_code,200)
@@ -73,6 +141,1041 @@ class TestCabinet(unittest.TestCase):
         self.assertIn('title', loaded['results'][0])
         self.assertEqual( len(loaded['results']),7)
 
+class FakePage(object):
+    """ Stands in for the requests object returned by get_web_page so that
+    the linked pages can be served from local data.
+    """
+    def __init__(self, url, text):
+        self.url = url
+        self.text = text
+        self.content = text.encode('utf-8') if isinstance(text, unicode) else text
+        self.status_code = 200
+
+def fake_get_web_page(url):
+    # Sleep for a varying time so that concurrent fetches finish out of order.
+    time.sleep(random.random() / 100)
+    if 'missing' in url :
+        raise requests.exceptions.HTTPError('404 Client Error: Not Found')
+    if url.startswith(testUrl) :
+        return FakePage(url, TESTHTML)
+    if url in PAGED_LISTINGS :
+        return FakePage(url, PAGED_LISTINGS[url])
+    return FakePage(url, TEST_DESCRIPTION_HTML)
+
+class TestLocalPages(unittest.TestCase):
+    """ Tests that scrape the test pages with get_web_page replaced by
+    fake_get_web_page so that no network access is needed. The urls fetched
+    are recorded in self.fetched.
+    """
+
+    def setUp(self):
+        self.realGetWebPage = cabinet.get_web_page
+        self.fetched = []
+        def get_web_page(url) :
+            self.fetched.append(url)
+            return fake_get_web_page(url)
+        cabinet.get_web_page = get_web_page
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        cabinet.get_web_page = self.realGetWebPage
+        cabinet.configure_journal(None)
+        cabinet.configure_incremental(None)
+        cabinet.configure_listing_streaming()
+        shutil.rmtree(self.directory)
+
+    def test_fetch_pages_keeps_url_order(self):
+        urls = ['http://example.com/%d' % i for i in range(20)]
+        pages = cabinet.fetch_pages(urls, 4)
+        self.assertEqual( [p.url for p in pages], urls )
+
+    def test_fetch_pages_serial_when_one_in_flight(self):
+        urls = ['http://example.com/%d' % i for i in range(5)]
+        pages = cabinet.fetch_pages(urls, 1)
+        self.assertEqual( [p.url for p in pages], urls )
+
+    def test_scrape_page_keeps_page_order(self):
+        serial = cabinet.scrape_page(TESTHTML, 1)
+        concurrent = cabinet.scrape_page(TESTHTML, 4)
+        self.assertEqual( len(concurrent),7 )
+        self.assertEqual( concurrent, serial )
+
+    def test_iter_scrape_page_yields_same_results(self):
+        res = cabinet.iter_scrape_page(TESTHTML, 4)
+        self.assertIsInstance(res, types.GeneratorType)
+        self.assertEqual( list(res), cabinet.scrape_page(TESTHTML, 4) )
+
+    def test_iter_scrape_page_can_stop_early(self):
+        res = cabinet.iter_scrape_page(TESTHTML, 4)
+        first = next(res)
+        self.assertEqual( first['description'], u'Avocados' )
+        res.close()
+
+    def test_listing_items_parses_prices_in_one_batch(self):
+        calls = []
+        realParse = cabinet.parse_prices
+        def parse_prices(texts) :
+            calls.append(len(texts))
+            return realParse(texts)
+        cabinet.parse_prices = parse_prices
+        try :
+            items = list(cabinet.listing_items(TESTHTML))
+        finally :
+            cabinet.parse_prices = realParse
+        self.assertEqual( calls, [7] )
+        self.assertEqual( len(items), 7 )
+
+    def test_listing_items_gives_links(self):
+        items = list(cabinet.listing_items(TESTHTML))
+        self.assertEqual( len(items),7 )
+        pageDict, url = items[0]
+        self.assertEqual( sorted(pageDict.keys()), ['currency', 'title', 'unit', 'unit_price'] )
+        self.assertEqual( (pageDict['currency'], pageDict['unit']), ('GBP', 'unit') )
+        self.assertTrue( url.startswith('http://') )
+
+    def test_scrape_gives_help_message_for_bad_option(self) :
+        res = cabinet.scrape(['cabinet.py', '--workers=many', testUrl])
+        self.assertTrue( 'command' in res )
+
+    def test_scrape_puts_back_the_settings(self) :
+        before = cabinet._settings()
+        cabinet.scrape(['cabinet.py', '--cache=' + self.directory, '--rate=2',
+                        '--parser=html5lib', '--full-parse', '--retries=0', testUrl],
+                       StringIO.StringIO())
+        self.assertEqual( cabinet._settings(), before )
+        cabinet.scrape(['cabinet.py', '--parser=html5lib', '--workers=many', testUrl])
+        self.assertEqual( cabinet._settings(), before )
+
+    def test_scrape_writes_json(self) :
+        out = StringIO.StringIO()
+        res = cabinet.scrape(['cabinet.py', testUrl], out)
+        loaded = json.loads(out.getvalue())
+        self.assertEqual( loaded, json.loads(res) )
+        self.assertEqual( len(loaded['results']),7)
+
+    def test_scrape_streams_ndjson(self) :
+        out = StringIO.StringIO()
+        cabinet.scrape(['cabinet.py', '--ndjson', testUrl], out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual( len(lines),8)
+        for p in ['title', 'size', 'unit_price', 'description']:
+            self.assertIn(p, lines[0])
+        self.assertEqual( lines[-1].keys(), ['total'] )
+        self.assertAlmostEqual( lines[-1]['total'],
+                                sum([d['unit_price'] for d in lines[:-1]]) )
+
+    def test_scrape_writes_compact_json(self) :
+        out = StringIO.StringIO()
+        cabinet.scrape(['cabinet.py', '--format=compact', testUrl], out)
+        self.assertNotIn('\n ', out.getvalue())
+        indented = StringIO.StringIO()
+        cabinet.scrape(['cabinet.py', testUrl], indented)
+        self.assertEqual( json.loads(out.getvalue()), json.loads(indented.getvalue()) )
+
+    def test_scrape_writes_csv(self) :
+        out = StringIO.StringIO()
+        cabinet.scrape(['cabinet.py', '--format=csv', testUrl], out)
+        rows = list(csv.reader(StringIO.StringIO(out.getvalue())))
+        self.assertEqual( rows[0], list(cabinet.PRODUCT_FIELDS) )
+        self.assertEqual( len(rows), 8 )
+        self.assertEqual( rows[1][rows[0].index('description')], 'Avocados' )
+
+    def test_scrape_batch_writes_one_csv_header(self) :
+        out = StringIO.StringIO()
+        urls = [testUrl, testUrl + '?page=2']
+        cabinet.scrape(['cabinet.py', '--format=csv'] + urls, out)
+        rows = list(csv.reader(StringIO.StringIO(out.getvalue())))
+        self.assertEqual( rows[0][-1], 'listing' )
+        self.assertEqual( len(rows), 1 + 2 * 7 )
+        self.assertEqual( [row[-1] for row in rows[1:]], [urls[0]] * 7 + [urls[1]] * 7 )
+
+    def test_scrape_writes_columnar_file(self) :
+        path = os.path.join(self.directory, 'products.cabt')
+        urls = [testUrl, testUrl + '?page=2']
+        res = cabinet.scrape(['cabinet.py', '--format=columnar', '--output=' + path] + urls)
+        with open(path, 'rb') as f :
+            listings = list(cabinet.read_columnar(f))
+        self.assertEqual( [url for url, table in listings], urls )
+        expected = cabinet.ProductTable(cabinet.scrape_page(TESTHTML, 1))
+        for url, table in listings :
+            self.assertEqual( list(table), list(expected) )
+        self.assertEqual( res, [expected.total()] * 2 )
+
+    def test_scrape_gives_help_message_for_unknown_format(self) :
+        res = cabinet.scrape(['cabinet.py', '--format=xml', testUrl])
+        self.assertTrue( 'command' in res )
+
+    def test_scrape_batch_writes_each_listing(self) :
+        out = StringIO.StringIO()
+        urls = [testUrl, testUrl + '?page=2']
+        cabinet.scrape(['cabinet.py'] + urls, out)
+        loaded = json.loads(out.getvalue())
+        self.assertEqual( [listing['url'] for listing in loaded], urls )
+        for listing in loaded :
+            self.assertEqual( len(listing['results']),7)
+            self.assertIn('total', listing)
+
+    def test_scrape_batch_fetches_shared_products_once(self) :
+        urls = [testUrl, testUrl + '?page=2']
+        cabinet.scrape(['cabinet.py'] + urls, StringIO.StringIO())
+        products = [url for url in self.fetched if url not in urls]
+        self.assertEqual( len(products), 7 )
+        self.assertEqual( len(set(products)), 7 )
+
+    def test_repeated_product_is_fetched_once(self) :
+        url = 'http://example.com/pear?b=2&a=1'
+        items = [({'n':1}, url), ({'n':2}, 'HTTP://Example.com:80/pear?a=1&b=2#top'),
+                 ({'n':3}, 'http://example.com/fig')]
+        res = list(cabinet._iter_scrape_items(items, 4, None))
+        self.assertEqual( self.fetched, [url, 'http://example.com/fig'] )
+        self.assertEqual( [d['n'] for d in res], [1, 2, 3] )
+        self.assertEqual( res[1]['description'], res[0]['description'] )
+
+    def test_pipeline_fetches_shared_products_once(self) :
+        pipeline = cabinet.Pipeline(fetch_workers=4, queue_size=2)
+        res = list(pipeline.run([pagedUrl, testUrl], max_pages=None))
+        self.assertEqual( len(res), 28 )
+        products = [url for url in self.fetched if url not in PAGED_LISTINGS and url != testUrl]
+        self.assertEqual( len(products), 7 )
+
+    def test_interleaved_scrapes_share_claims_without_waiting_for_each_other(self) :
+        cabinet.configure_dedupe(True)
+        items = [({'n':i}, 'http://example.com/%d' % i) for i in range(5)]
+        res = []
+        def scrape() :
+            first = cabinet._iter_scrape_items(items, 4, None)
+            second = cabinet._iter_scrape_items(items[1:], 4, None)
+            res.append(next(first))
+            res.append(next(second))
+            res.extend(list(first) + list(second))
+        thread = threading.Thread(target=scrape)
+        thread.daemon = True
+        try :
+            thread.start()
+            thread.join(10)
+        finally :
+            cabinet.configure_dedupe(False)
+        self.assertFalse( thread.is_alive() )
+        self.assertEqual( sorted(d['n'] for d in res), [0, 1, 1, 2, 2, 3, 3, 4, 4] )
+
+    def test_abandoned_claim_is_released(self) :
+        table = cabinet.DedupeTable()
+        items = [({}, 'http://example.com/%d' % i) for i in range(5)]
+        res = cabinet._iter_scrape_items(items, 1, None, table)
+        next(res)
+        res.close()
+        future, owner = table.claim('http://example.com/1')
+        self.assertTrue( owner )
+        self.assertEqual( table.claim('http://example.com/0')[0].result(0)['description'],
+                          u'Avocados' )
+
+    def test_scrape_batch_interleaves_hosts(self) :
+        runs = []
+        realListings = cabinet.Pipeline.listings
+        def listings(pipeline, urls, max_pages=1) :
+            runs.append(urls)
+            return realListings(pipeline, urls, max_pages)
+        cabinet.Pipeline.listings = listings
+        try :
+            out = StringIO.StringIO()
+            urls = [testUrl, pagedUrl]
+            cabinet.scrape(['cabinet.py'] + urls, out)
+        finally :
+            cabinet.Pipeline.listings = realListings
+        self.assertEqual( runs, [urls] )
+        loaded = json.loads(out.getvalue())
+        self.assertEqual( [listing['url'] for listing in loaded], urls )
+        self.assertEqual( [len(listing['results']) for listing in loaded], [7, 7] )
+
+    def test_scrape_batch_over_hosts_skips_listing_with_missing_product(self) :
+        missingListing = 'http://example.com/fruit/broken.html'
+        PAGED_LISTINGS[missingListing] = TESTHTML.replace(
+            'sainsburys-apricot-ripe---ready-320g.html', 'missing.html')
+        try :
+            out = StringIO.StringIO()
+            urls = [testUrl, missingListing, pagedUrl3]
+            res = cabinet.scrape(['cabinet.py'] + urls, out)
+        finally :
+            del PAGED_LISTINGS[missingListing]
+        self.assertEqual( len(res), 2 )
+        loaded = json.loads(out.getvalue())
+        self.assertEqual( [listing['url'] for listing in loaded], [testUrl, pagedUrl3] )
+        self.assertEqual( len(loaded[0]['results']), 7 )
+
+    def test_pipeline_writes_empty_listing(self) :
+        emptyListing = 'http://example.com/fruit/empty.html'
+        PAGED_LISTINGS[emptyListing] = '<html><body><p>Nothing today</p></body></html>'
+        try :
+            out = StringIO.StringIO()
+            urls = [testUrl, emptyListing]
+            cabinet.scrape(['cabinet.py'] + urls, out)
+        finally :
+            del PAGED_LISTINGS[emptyListing]
+        loaded = json.loads(out.getvalue())
+        self.assertEqual( [listing['url'] for listing in loaded], urls )
+        self.assertEqual( loaded[1]['results'], [] )
+
+    def test_scrape_batch_reads_url_file(self) :
+        out = StringIO.StringIO()
+        urlFile = tempfile.NamedTemporaryFile(delete=False)
+        urlFile.write('# listings\n%s?page=2\n\n%s?page=3\n' % (testUrl, testUrl))
+        urlFile.close()
+        try :
+            cabinet.scrape(['cabinet.py', '--ndjson', '--urls=' + urlFile.name, testUrl], out)
+        finally :
+            os.remove(urlFile.name)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        totals = [line for line in lines if 'total' in line]
+        self.assertEqual( [line['listing'] for line in totals],
+                          [testUrl, testUrl + '?page=2', testUrl + '?page=3'] )
+        self.assertEqual( len(lines), 3 * 8 )
+
+    def test_scrape_batch_skips_failed_listing(self) :
+        out = StringIO.StringIO()
+        urls = [testUrl, 'http://example.com/missing', testUrl + '?page=2']
+        res = cabinet.scrape(['cabinet.py'] + urls, out)
+        self.assertEqual( len(res), 2 )
+        loaded = json.loads(out.getvalue())
+        self.assertEqual( [listing['url'] for listing in loaded], [urls[0], urls[2]] )
+
+    def test_next_page_url_on_last_page(self) :
+        soup = cabinet.make_soup(TESTHTML)
+        self.assertIsNone( cabinet.next_page_url(soup, testUrl) )
+
+    def test_next_page_url_resolves_link(self) :
+        soup = cabinet.make_soup(PAGED_LISTINGS[pagedUrl])
+        self.assertEqual( cabinet.next_page_url(soup, pagedUrl), pagedUrl2 )
+
+    def test_iter_scrape_listing_follows_pages(self) :
+        for maxInFlight in [1, 4] :
+            res = list(cabinet.iter_scrape_listing(pagedUrl, maxInFlight, max_pages=None))
+            self.assertEqual( len(res),21 )
+            self.assertEqual( res[:7], res[7:14] )
+
+    def test_iter_scrape_listing_limits_pages(self) :
+        res = list(cabinet.iter_scrape_listing(pagedUrl, 4, max_pages=2))
+        self.assertEqual( len(res),14 )
+        res = list(cabinet.iter_scrape_listing(pagedUrl, 4))
+        self.assertEqual( len(res),7 )
+
+    def test_iter_scrape_listing_stops_at_loop(self) :
+        res = list(cabinet.iter_scrape_listing(loopUrl, 4, max_pages=None))
+        self.assertEqual( len(res),7 )
+
+    def test_scrape_follows_all_pages(self) :
+        out = StringIO.StringIO()
+        cabinet.scrape(['cabinet.py', '--pages=all', pagedUrl], out)
+        self.assertEqual( len(json.loads(out.getvalue())['results']),21 )
+
+    def test_parse_pool_gives_same_results(self) :
+        expected = cabinet.scrape_page(TESTHTML, 4)
+        cabinet.configure_parse_pool(2)
+        try :
+            res = cabinet.scrape_page(TESTHTML, 4)
+        finally :
+            cabinet.configure_parse_pool(0)
+        self.assertEqual( res, expected )
+
+    def test_scrape_with_parse_workers(self) :
+        out = StringIO.StringIO()
+        cabinet.scrape(['cabinet.py', '--parse-workers=2', testUrl], out)
+        self.assertEqual( len(json.loads(out.getvalue())['results']),7)
+        self.assertIsNone( cabinet._parsePool )
+
+    def test_pipeline_matches_serial_scrape(self) :
+        expected = list(cabinet.iter_scrape_listing(pagedUrl, 1, max_pages=None))
+        expected += list(cabinet.iter_scrape_listing(testUrl, 1))
+        pipeline = cabinet.Pipeline(listing_workers=2, fetch_workers=4,
+                                    parse_workers=2, queue_size=2)
+        res = list(pipeline.run([pagedUrl, testUrl], max_pages=None))
+        self.assertEqual( [url for url, pageDict in res], [pagedUrl] * 21 + [testUrl] * 7 )
+        self.assertEqual( [pageDict for url, pageDict in res], expected )
+
+    def test_pipeline_skips_failed_listing(self) :
+        pipeline = cabinet.Pipeline(queue_size=2)
+        res = list(pipeline.run(['http://example.com/missing', testUrl]))
+        self.assertEqual( [url for url, pageDict in res], [testUrl] * 7 )
+
+    def test_pipeline_can_stop_early(self) :
+        threads = threading.active_count()
+        pipeline = cabinet.Pipeline(queue_size=1)
+        res = pipeline.run([pagedUrl], max_pages=None)
+        self.assertEqual( next(res)[0], pagedUrl )
+        res.close()
+        # The stage threads have all finished
+        self.assertEqual( threading.active_count(), threads )
+
+    def test_scrape_with_pipeline(self) :
+        out = StringIO.StringIO()
+        cabinet.scrape(['cabinet.py', '--pipeline', '--queue-size=4', testUrl, pagedUrl], out)
+        loaded = json.loads(out.getvalue())
+        self.assertEqual( [len(listing['results']) for listing in loaded], [7, 7] )
+
+    def test_journal_skips_completed_products(self) :
+        expected = cabinet.scrape_page(TESTHTML, 4)
+        journal = cabinet.configure_journal('fruit', self.directory)
+        # Interrupt the first run after three products
+        res = cabinet.iter_scrape_page(TESTHTML, 4)
+        first = [next(res) for i in range(3)]
+        res.close()
+        self.assertEqual( len(journal.done), 3 )
+        cabinet.configure_journal(None)
+        cabinet.configure_journal('fruit', self.directory)
+        del self.fetched[:]
+        res = cabinet.scrape_page(TESTHTML, 4)
+        self.assertEqual( res, expected )
+        self.assertEqual( len(self.fetched), 4 )
+        self.assertEqual( res[:3], first )
+
+    def test_journal_ignores_incomplete_line(self) :
+        path = os.path.join(self.directory, 'fruit.journal')
+        with open(path, 'wb') as f :
+            f.write('{"details": {"description": "Pears", "size": "1.0Kb"}, "url": "http://a/1"}\n{"det')
+        journal = cabinet.configure_journal('fruit', self.directory)
+        self.assertEqual( journal.get('http://a/1')['description'], 'Pears' )
+        self.assertIsNone( journal.get('http://a/2') )
+        journal.record('http://a/2', {'description':'Figs', 'size':'2.0Kb'})
+        journal = cabinet.configure_journal('fruit', self.directory)
+        self.assertEqual( journal.get('http://a/1')['description'], 'Pears' )
+        self.assertEqual( journal.get('http://a/2')['description'], 'Figs' )
+
+    def test_pipeline_uses_journal(self) :
+        cabinet.configure_journal('fruit', self.directory)
+        list(cabinet.iter_scrape_listing(testUrl, 4))
+        del self.fetched[:]
+        pipeline = cabinet.Pipeline(queue_size=2)
+        res = list(pipeline.run([testUrl]))
+        self.assertEqual( len(res),7 )
+        self.assertEqual( self.fetched, [testUrl] )
+
+    def test_scan_listing_finds_items_and_next_page(self) :
+        for url, html in PAGED_LISTINGS.items() :
+            tags, nextUrl = cabinet.parse_listing(html, url)
+            fragments, scannedUrl = cabinet.scan_listing(html, url)
+            self.assertIsInstance(fragments, types.GeneratorType)
+            fragments = list(fragments)
+            self.assertEqual( scannedUrl.result(0), nextUrl.result(0) )
+            self.assertEqual( len(fragments), 7 )
+            res = cabinet.fragment_tags(fragments)
+            self.assertIsInstance(res, types.GeneratorType)
+            self.assertEqual( list(cabinet.product_items(res)), list(cabinet.product_items(tags)) )
+
+    def test_scan_listing_ends_items_left_open(self) :
+        item = ('<li class="productInner"><div class="productInfo"><h3><a href="/p%d.html">'
+                'Pear %d</a></h3></div><div class="pricing"><p class="pricePerUnit">'
+                '&pound;1.%d0/unit</p>')
+        unclosedLi = '<ul>' + ''.join(item % (i, i, i) for i in range(3)) + '</ul>'
+        unclosedDiv = '<div>' + ''.join(item.replace('<li', '<div') % (i, i, i) + '<div>'
+                                         for i in range(3)) + '</div>'
+        for html in (unclosedLi, unclosedDiv) :
+            expected = list(cabinet.product_items(cabinet.parse_listing(html, '')[0]))
+            self.assertEqual( len(expected), 3 )
+            fragments = list(cabinet.scan_listing(html, '')[0])
+            self.assertEqual( len(fragments), 3 )
+            res = list(cabinet.product_items(cabinet.fragment_tags(fragments)))
+            self.assertEqual( res, expected )
+
+    def test_streamed_listing_yields_items_as_they_are_scanned(self) :
+        cabinet.configure_listing_streaming(0)
+        html = TESTHTML + ' ' * (2 * cabinet.LISTING_SCAN_CHUNK)
+        tags, nextUrl = cabinet.parse_listing(html, testUrl)
+        items = cabinet.product_items(tags)
+        self.assertEqual( next(items)[0]['title'], cabinet.scrape_page(TESTHTML, 1)[0]['title'] )
+        self.assertFalse( nextUrl.done() )
+        self.assertEqual( len(list(items)), 6 )
+        self.assertIsNone( nextUrl.result(0) )
+
+    def test_streamed_listing_falls_back_to_whole_parse(self) :
+        cabinet.configure_listing_streaming(0)
+        html = '<div class="productInner"><a href="/p.html">Pear</a><p class="pricePerUnit">&pound;1</div>'
+        realScan = cabinet.scan_listing
+        # A scan that makes out no items at all
+        cabinet.scan_listing = lambda htmlText, url : realScan('', url)
+        try :
+            tags, nextUrl = cabinet.parse_listing(html, 'http://example.com/')
+            self.assertEqual( len(list(tags)), 1 )
+        finally :
+            cabinet.scan_listing = realScan
+        self.assertIsNone( nextUrl.result(0) )
+
+    def test_streamed_listing_gives_same_results(self) :
+        expected = list(cabinet.iter_scrape_listing(pagedUrl, 4, max_pages=None))
+        cabinet.configure_listing_streaming(0)
+        self.assertEqual( list(cabinet.iter_scrape_listing(pagedUrl, 4, max_pages=None)), expected )
+        self.assertEqual( cabinet.scrape_page(TESTHTML, 4), expected[:7] )
+
+    def test_product_table_gives_back_products(self) :
+        results = cabinet.scrape_page(TESTHTML, 4)
+        table = cabinet.ProductTable(results)
+        self.assertEqual( len(table), 7 )
+        self.assertEqual( [product.as_dict() for product in table], results )
+        self.assertEqual( table[2], cabinet.Product.from_dict(results[2]) )
+        self.assertEqual( table.total(), cabinet.total_price(d['unit_price'] for d in results) )
+        self.assertEqual( table.prices.typecode, 'l' )
+        self.assertEqual( table.currencies.values, ['GBP'] )
+
+    def test_product_table_writes_csv(self) :
+        table = cabinet.ProductTable([{'title':u'Pear, ripe', 'unit_price':Decimal('1.20'),
+                                       'currency':'GBP', 'unit':u'kg',
+                                       'description':u'Pears £1', 'size':'  2.0Kb'},
+                                      cabinet.Product(u'Fig', Decimal('3'))])
+        out = StringIO.StringIO()
+        table.write_csv(out)
+        self.assertEqual( out.getvalue().splitlines(),
+                          ['title,unit_price,currency,unit,description,size',
+                           '"Pear, ripe",1.20,GBP,kg,Pears \xc2\xa31,  2.0Kb',
+                           'Fig,3.00,,,,'] )
+
+    def test_product_table_keeps_fractions_of_a_penny(self) :
+        table = cabinet.ProductTable([cabinet.Product(u'Rice', Decimal('0.125'), 'GBP', u'kg'),
+                                      cabinet.Product(u'Fig', Decimal('3'), 'GBP'),
+                                      cabinet.Product(u'Fuel', 1.459, 'GBP', u'litre')])
+        self.assertEqual( table[0].unit_price, Decimal('0.125') )
+        self.assertEqual( table[-1].unit_price, Decimal('1.459') )
+        self.assertEqual( table.total(), Decimal('4.584') )
+        out = StringIO.StringIO()
+        table.write_columnar(out, 'http://a/')
+        out.seek(0)
+        url, copy = cabinet.ProductTable.read_columnar(out)
+        self.assertEqual( list(copy), list(table) )
+        self.assertEqual( copy.total(), Decimal('4.584') )
+
+    def test_product_has_no_dict(self) :
+        product = cabinet.Product(u'Fig')
+        self.assertFalse( hasattr(product, '__dict__') )
+        self.assertRaises(ValueError, cabinet.price_minor_units, Decimal('1.005'))
+
+    def test_incremental_fetches_only_changed_products(self) :
+        path = os.path.join(self.directory, 'state.json')
+        cabinet.configure_incremental(path)
+        expected = list(cabinet.iter_scrape_listing(testUrl, 4))
+        cabinet.configure_incremental(None)
+        cabinet.configure_incremental(path)
+        del self.fetched[:]
+        self.assertEqual( list(cabinet.iter_scrape_listing(testUrl, 4)), expected )
+        self.assertEqual( self.fetched, [testUrl] )
+        # A new title changes the listing entry but a new price does not
+        changed = TESTHTML.replace('Apricot Ripe', 'Apricot Riper').replace('3.50', '3.60')
+        del self.fetched[:]
+        res = cabinet.scrape_page(changed, 4)
+        self.assertEqual( len(self.fetched), 1 )
+        self.assertEqual( res[0]['title'], expected[0]['title'].replace('Ripe', 'Riper') )
+
+    def test_incremental_reuses_unchanged_page_details(self) :
+        state = cabinet.configure_incremental(os.path.join(self.directory, 'state.json'))
+        url = 'http://a/1'
+        state.note_listing(url, 'listing')
+        state.record(url, cabinet.fingerprint(u'<p>page</p>'), {'description':'Pears'})
+        self.assertEqual( state.unchanged(url), {'description':'Pears'} )
+        state.note_listing(url, 'changed')
+        self.assertIsNone( state.unchanged(url) )
+        self.assertEqual( state.page_unchanged(url, cabinet.fingerprint(u'<p>page</p>')),
+                          {'description':'Pears'} )
+
+    def test_scrape_saves_incremental_state(self) :
+        path = os.path.join(self.directory, 'state.json')
+        cabinet.scrape(['cabinet.py', '--state=' + path, testUrl], StringIO.StringIO())
+        del self.fetched[:]
+        cabinet.scrape(['cabinet.py', '--pipeline', '--state=' + path, testUrl], StringIO.StringIO())
+        self.assertEqual( self.fetched, [testUrl] )
+
+    def test_scrape_rejects_bad_job_id(self) :
+        res = cabinet.scrape(['cabinet.py', '--job=../fruit', testUrl])
+        self.assertTrue( 'command' in res )
+
+    def test_write_ndjson_writes_each_result_before_the_next(self) :
+        out = StringIO.StringIO()
+        def results() :
+            for i in range(3) :
+                # Every earlier result is already written
+                self.assertEqual( len(out.getvalue().splitlines()), i )
+                yield {'unit_price':1.5}
+        cabinet.write_ndjson(results(), out)
+        self.assertEqual( out.getvalue().splitlines()[-1], '{"total": 4.5}' )
+
+class FixtureAdapter(requests.adapters.BaseAdapter):
+    """ A requests transport adapter that answers every request from a dict
+    of url to html text rather than going to the network. Each request is
+    recorded in self.requests. If etags gives an ETag for a url then a
+    matching If-None-Match request is answered with 304 Not Modified.
+    failures maps a url to a list of the failures for its first requests,
+    each an exception to raise or a (status code, headers) pair to return.
+    """
+    def __init__(self, pages, etags=None, failures=None):
+        super(FixtureAdapter, self).__init__()
+        self.pages = pages
+        self.etags = etags or {}
+        self.failures = failures or {}
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = requests.Response()
+        failures = self.failures.get(request.url)
+        if failures :
+            failure = failures.pop(0)
+            if isinstance(failure, Exception) :
+                raise failure
+            response.status_code, headers = failure
+            response.headers.update(headers)
+            response._content = b''
+            response.url = request.url
+            return response
+        response.request = request
+        response.url = request.url
+        etag = self.etags.get(request.url)
+        if etag :
+            response.headers['ETag'] = etag
+        if etag and request.headers.get('If-None-Match') == etag :
+            response.status_code = 304
+            response._content = b''
+        elif request.url in self.pages :
+            response.status_code = 200
+            response._content = self.pages[request.url].encode('utf-8')
+        else :
+            response.status_code = 404
+            response._content = b''
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        pass
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.session = cabinet.configure_session(pool_maxsize=4,
+                                                 host_pool_sizes={'shop.example.com':16})
+
+    def tearDown(self):
+        cabinet.configure_session()
+
+    def test_get_session_returns_shared_session(self):
+        self.assertIs( cabinet.get_session(), self.session )
+        self.assertIs( cabinet.get_session(), cabinet.get_session() )
+
+    def test_configure_session_sizes_host_pools(self):
+        default = self.session.get_adapter('http://other.example.com/page')
+        shop = self.session.get_adapter('http://shop.example.com/page')
+        self.assertEqual( default._pool_maxsize, 4 )
+        self.assertEqual( shop._pool_maxsize, 16 )
+
+    def test_get_web_page_uses_shared_session(self):
+        adapter = FixtureAdapter({'http://fixture.test/a':u'<p>a</p>'})
+        self.session.mount('http://fixture.test/', adapter)
+        res = cabinet.get_web_page('http://fixture.test/a')
+        self.assertEqual( res.text, u'<p>a</p>' )
+        self.assertEqual( len(adapter.requests), 1 )
+
+    def test_get_web_page_asks_for_compressed_page(self):
+        adapter = FixtureAdapter({'http://fixture.test/a':u'<p>£1</p>'})
+        self.session.mount('http://fixture.test/', adapter)
+        res = cabinet.get_web_page('http://fixture.test/a')
+        self.assertIn( 'gzip', adapter.requests[0].headers['Accept-Encoding'] )
+        # No charset is given so utf-8 is used, not ISO-8859-1 or chardet
+        self.assertEqual( res.encoding, 'utf-8' )
+        self.assertEqual( res.text, u'<p>£1</p>' )
+
+    def test_page_encoding_uses_header_then_meta_tag(self):
+        res = requests.Response()
+        res._content = u'<meta charset="iso-8859-1"><p>£1</p>'.encode('latin-1')
+        self.assertEqual( cabinet.page_encoding(res), 'iso8859-1' )
+        res.headers['Content-Type'] = 'text/html; charset=UTF-8'
+        self.assertEqual( cabinet.page_encoding(res), 'utf-8' )
+        res.headers['Content-Type'] = 'text/html; charset=no-such-charset'
+        res._content = b'<p>1</p>'
+        self.assertEqual( cabinet.page_encoding(res), 'utf-8' )
+
+    def test_page_details_size_is_byte_count(self):
+        res = cabinet.page_details(TEST_DESCRIPTION_HTML, 2048)
+        self.assertEqual( res['size'], '  2.0Kb' )
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.adapter = FixtureAdapter({'http://fixture.test/a':u'<p>a</p>',
+                                       'http://fixture.test/b':u'<p>b</p>',
+                                       'http://fixture.test/c':u'<p>c</p>'},
+                                      etags={'http://fixture.test/a':'"v1"'})
+        cabinet.configure_session().mount('http://fixture.test/', self.adapter)
+
+    def tearDown(self):
+        cabinet.configure_cache(None)
+        cabinet.configure_session()
+        shutil.rmtree(self.directory)
+
+    def test_fresh_page_is_not_refetched(self):
+        cabinet.configure_cache(self.directory, ttl=3600)
+        first = cabinet.get_web_page('http://fixture.test/a')
+        second = cabinet.get_web_page('http://fixture.test/a')
+        self.assertEqual( second.text, first.text )
+        self.assertEqual( len(self.adapter.requests), 1 )
+
+    def test_stale_page_is_revalidated(self):
+        cabinet.configure_cache(self.directory, ttl=0)
+        cabinet.get_web_page('http://fixture.test/a')
+        res = cabinet.get_web_page('http://fixture.test/a')
+        self.assertEqual( res.status_code, 200 )
+        self.assertEqual( res.text, u'<p>a</p>' )
+        self.assertEqual( len(self.adapter.requests), 2 )
+        self.assertEqual( self.adapter.requests[1].headers['If-None-Match'], '"v1"' )
+
+    def test_least_recently_used_page_is_evicted(self):
+        cache = cabinet.configure_cache(self.directory, max_bytes=16)
+        cabinet.get_web_page('http://fixture.test/a')
+        os.utime(cache._path('http://fixture.test/a', '.body'), (0, 0))
+        cabinet.get_web_page('http://fixture.test/b')
+        os.utime(cache._path('http://fixture.test/b', '.body'), (1, 1))
+        cabinet.get_web_page('http://fixture.test/c')
+        self.assertIsNone( cache.lookup('http://fixture.test/a') )
+        self.assertIsNotNone( cache.lookup('http://fixture.test/b') )
+        self.assertIsNotNone( cache.lookup('http://fixture.test/c') )
+
+    def test_store_lists_the_directory_once(self):
+        cache = cabinet.configure_cache(self.directory, max_bytes=16)
+        realListdir = os.listdir
+        listed = []
+        def listdir(path) :
+            listed.append(path)
+            return realListdir(path)
+        os.listdir = listdir
+        try :
+            for url in ['http://fixture.test/a', 'http://fixture.test/b', 'http://fixture.test/c'] :
+                cabinet.get_web_page(url)
+        finally :
+            os.listdir = realListdir
+        self.assertEqual( listed, [self.directory] )
+        self.assertEqual( cache.size, 16 )
+        self.assertIsNone( cache.lookup('http://fixture.test/a') )
+
+def listing_fields(tags):
+    """ The fields scrape_page takes from each productInner tag.
+    """
+    return [ (cabinet.extract_price(tag.find(class_='pricePerUnit').text),
+              tag.find(class_='productInfo').a.text.strip(),
+              tag.find(class_='productInfo').a['href']) for tag in tags ]
+
+class TestParserCompatibility(unittest.TestCase):
+    """ Every installed parser must give the same results as html5lib on the
+    test pages.
+    """
+    def tearDown(self):
+        cabinet.configure_parser(cabinet.available_parsers()[0])
+
+    def test_html_parser_is_always_available(self):
+        self.assertIn('html.parser', cabinet.available_parsers())
+
+    def test_configure_parser_rejects_unknown_parser(self):
+        self.assertRaises(ValueError, cabinet.configure_parser, 'no-such-parser')
+
+    def test_parsers_find_same_listing_fields(self):
+        cabinet.configure_parser('html5lib')
+        expected = listing_fields(cabinet.get_outer_tags(TESTHTML))
+        for parser in cabinet.available_parsers() :
+            cabinet.configure_parser(parser)
+            res = listing_fields(cabinet.get_outer_tags(TESTHTML))
+            self.assertEqual(res, expected, msg='Failed with %s' % parser)
+
+    def test_parsers_find_same_description(self):
+        for parser in cabinet.available_parsers() :
+            soup = cabinet.make_soup(TEST_DESCRIPTION_HTML, parser)
+            res = cabinet.extract_description(soup)
+            self.assertEqual(res, u'Avocados', msg='Failed with %s' % parser)
+
+class TestExtractionPlan(unittest.TestCase):
+
+    def test_plan_extracts_all_fields(self):
+        tag = cabinet.get_outer_tags(TESTHTML)[0]
+        res = cabinet.get_profile().listing_plan.extract(tag)
+        self.assertEqual( (cabinet.extract_price(res['price']), res['title'], res['href']),
+                          listing_fields([tag])[0] )
+        self.assertEqual( res['info'], unicode(tag.find(class_='productInfo')) )
+
+    def test_plan_gives_none_for_missing_field(self):
+        plan = cabinet.ExtractionPlan({'name':'ul li.name', 'link':'a@href'})
+        soup = cabinet.make_soup(u'<div><ul><li class="name">Pear</li></ul><li class="name">Fig</li></div>')
+        self.assertEqual( plan.extract(soup), {'name':u'Pear', 'link':None} )
+
+    def test_plan_matches_later_sibling(self):
+        plan = cabinet.ExtractionPlan({'text':'h3:contains(Size) ~ p'})
+        soup = cabinet.make_soup(u'<p>a</p><h3>Name</h3><p>b</p><h3>Size</h3><div></div><p>c</p>')
+        self.assertEqual( plan.extract(soup)['text'], u'c' )
+
+    def test_plan_matches_quoted_text(self):
+        plan = cabinet.ExtractionPlan({'text':'h3:contains("Size (g)") ~ p', 'note':"p:contains('a b')"})
+        soup = cabinet.make_soup(u'<h3>Size</h3><p>a</p><h3>Size (g)</h3><p>a b</p>')
+        self.assertEqual( plan.extract(soup), {'text':u'a b', 'note':u'a b'} )
+
+    def test_compile_selector_rejects_bad_selector(self):
+        for selector in ['', 'a ~', 'a#id', ':contains()', 'h3:contains(a (b))'] :
+            self.assertRaises(ValueError, cabinet.compile_selector, selector)
+
+class TestSiteProfiles(unittest.TestCase):
+    """ The test pages with their class names changed are scraped with a
+    profile that gives the new names.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'profiles.json')
+        settings = {'item':'shopItem',
+                    'listing':{'price':'.price', 'title':'h3 a', 'href':'h3 a@href'},
+                    'description_header':'heading',
+                    'description_text':'body'}
+        with open(self.path, 'wb') as f :
+            json.dump({'shop':settings}, f)
+        self.listing = TESTHTML.replace('"productInner"', '"shopItem"').replace('"pricePerUnit"', '"price"')
+        self.page = (TEST_DESCRIPTION_HTML.replace('productDataItemHeader', 'heading')
+                     .replace('"productText"', '"body"'))
+
+    def tearDown(self):
+        cabinet.configure_profile('sainsburys')
+        shutil.rmtree(self.directory)
+
+    def test_profile_scrapes_other_class_names(self):
+        expected = list(cabinet.product_items(cabinet.get_outer_tags(TESTHTML)))
+        cabinet.configure_profile('shop', self.path)
+        res = list(cabinet.product_items(cabinet.get_outer_tags(self.listing)))
+        self.assertEqual( res, expected )
+        self.assertEqual( cabinet.parse_description(self.page), u'Avocados' )
+        self.assertEqual( cabinet.parse_description(self.page, partial=False), u'Avocados' )
+
+    def test_profile_label_may_have_spaces_and_brackets(self):
+        page = self.page.replace('"heading">Description<', '"heading">Product (UK) Description<')
+        settings = {'item':'shopItem', 'description_label':'Product (UK) Description',
+                    'listing':{'price':'.price', 'title':'h3 a', 'href':'h3 a@href'},
+                    'description_header':'heading', 'description_text':'body'}
+        cabinet.PROFILES['label'] = cabinet.SiteProfile('label', settings)
+        try :
+            cabinet.configure_profile('label')
+            self.assertEqual( cabinet.parse_description(page), u'Avocados' )
+            self.assertEqual( cabinet.parse_description(page, partial=False), u'Avocados' )
+        finally :
+            del cabinet.PROFILES['label']
+        cabinet.SiteProfile('label', dict(settings, description_label='The "best" bit'))
+
+    def test_load_profiles_keeps_compiled_profiles(self):
+        profiles = cabinet.load_profiles(self.path)
+        self.assertIs( cabinet.load_profiles(self.path)['shop'], profiles['shop'] )
+
+    def test_configure_profile_rejects_unknown_profile(self):
+        self.assertRaises(ValueError, cabinet.configure_profile, 'nosuch', self.path)
+        self.assertIs( cabinet.get_profile(), cabinet.PROFILES['sainsburys'] )
+
+    def test_incomplete_profile_is_rejected(self):
+        self.assertRaises(ValueError, cabinet.SiteProfile, 'shop', {'item':'product'})
+        settings = dict(cabinet.SAINSBURYS_PROFILE, listing={'price':'.price'})
+        self.assertRaises(ValueError, cabinet.SiteProfile, 'shop', settings)
+
+class TestPartialParsing(unittest.TestCase):
+
+    def test_description_fragment_holds_only_description_block(self):
+        res = cabinet.description_fragment(TEST_DESCRIPTION_HTML)
+        self.assertIn(u'Avocados', res)
+        self.assertNotIn(u'Nutrition', res)
+
+    def test_description_fragment_missing(self):
+        self.assertIsNone( cabinet.description_fragment(TESTHTML) )
+
+    def test_parse_description_partial_matches_full(self):
+        for parser in cabinet.available_parsers() :
+            cabinet.configure_parser(parser)
+            partial = cabinet.parse_description(TEST_DESCRIPTION_HTML, True)
+            full = cabinet.parse_description(TEST_DESCRIPTION_HTML, False)
+            self.assertEqual(partial, u'Avocados', msg='Failed with %s' % parser)
+            self.assertEqual(partial, full, msg='Failed with %s' % parser)
+        cabinet.configure_parser(cabinet.available_parsers()[0])
+
+    def test_parse_description_falls_back_to_whole_page(self):
+        html = TEST_DESCRIPTION_HTML.replace('<div class="productText">\n<p>Avocados',
+                                             '<div>\n<p>Avocados', 1)
+        html = html.replace('<h3 class="productDataItemHeader">Nutrition</h3>',
+                            '<div class="productText">Late</div>', 1)
+        self.assertEqual( cabinet.parse_description(html, True), u'Late' )
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.realGetWebPage = cabinet.get_web_page
+        cabinet.get_web_page = fake_get_web_page
+        self.engine = cabinet.AsyncEngine(fetch_threads=2, parse_threads=2)
+
+    def tearDown(self):
+        self.engine.close()
+        cabinet.get_web_page = self.realGetWebPage
+
+    def test_future_then_chains_results(self):
+        future = cabinet.Future()
+        chained = future.then(lambda x : x + 1).then(lambda x : x * 2)
+        self.assertFalse( chained.done() )
+        future.set_result(1)
+        self.assertEqual( chained.result(1), 4 )
+
+    def test_get_web_page_returns_future(self):
+        future = self.engine.get_web_page(testUrl)
+        self.assertIsInstance( future, cabinet.Future )
+        self.assertEqual( future.result(10).text, TESTHTML )
+
+    def test_scrape_page_matches_sync_version(self):
+        res = self.engine.scrape_page(TESTHTML).result(10)
+        self.assertEqual( res, cabinet.scrape_page(TESTHTML, 1) )
+
+    def test_many_scrapes_share_small_pools(self):
+        futures = [self.engine.scrape(testUrl) for i in range(20)]
+        for future in futures :
+            res = future.result(30)
+            self.assertEqual( len(res['results']),7 )
+            self.assertAlmostEqual( res['total'], sum([d['unit_price'] for d in res['results']]) )
+
+    def test_scrape_passes_on_errors(self):
+        future = self.engine.scrape('http://example.com/missing')
+        self.assertRaises(requests.exceptions.HTTPError, future.result, 10)
+
+    def test_concurrent_scrapes_share_the_run_table(self):
+        fetched = []
+        def get_web_page(url) :
+            fetched.append(url)
+            return fake_get_web_page(url)
+        cabinet.get_web_page = get_web_page
+        cabinet.configure_dedupe(True)
+        try :
+            futures = [self.engine.scrape_page(TESTHTML) for i in range(3)]
+            res = [future.result(10) for future in futures]
+        finally :
+            cabinet.configure_dedupe(False)
+        self.assertEqual( len(fetched), 7 )
+        self.assertEqual( res, [res[0]] * 3 )
+        self.assertEqual( len(res[0]), 7 )
+
+    def test_module_functions_use_shared_engine(self):
+        self.assertIs( cabinet.get_async_engine(), cabinet.get_async_engine() )
+        res = cabinet.scrape_page_async(TESTHTML).result(10)
+        self.assertEqual( len(res),7 )
+
+
+class TestHostLimits(unittest.TestCase):
+
+    def test_limiter_spaces_requests_to_one_host(self):
+        limiter = cabinet.HostLimiter(rate=50, burst=1)
+        start = time.time()
+        for i in range(6) :
+            limiter.release(limiter.acquire('http://shop.example.com/%d' % i))
+        self.assertGreaterEqual( time.time() - start, 0.09 )
+
+    def test_limiter_does_not_delay_other_hosts(self):
+        limiter = cabinet.HostLimiter(rate=1, burst=1)
+        start = time.time()
+        for i in range(5) :
+            limiter.release(limiter.acquire('http://shop%d.example.com/' % i))
+        self.assertLess( time.time() - start, 0.5 )
+        self.assertFalse( limiter.ready('shop0.example.com') )
+        self.assertTrue( limiter.ready('shop9.example.com') )
+
+    def test_limiter_limits_concurrency(self):
+        limiter = cabinet.HostLimiter(rate=None, max_concurrency=2)
+        lock = threading.Lock()
+        active = [0, 0]
+        def fetch() :
+            host = limiter.acquire('http://shop.example.com/')
+            with lock :
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.01)
+            with lock :
+                active[0] -= 1
+            limiter.release(host)
+        threads = [threading.Thread(target=fetch) for i in range(8)]
+        for thread in threads :
+            thread.start()
+        for thread in threads :
+            thread.join()
+        self.assertEqual( active[1], 2 )
+
+    def test_host_queue_takes_hosts_in_turn(self):
+        queue = cabinet.HostQueue(host=cabinet.url_host)
+        for url in ['http://a/1', 'http://a/2', 'http://a/3', 'http://b/1', 'http://b/2'] :
+            queue.put(url)
+        res = [queue.get() for i in range(5)]
+        self.assertEqual( res, ['http://a/1', 'http://b/1', 'http://a/2',
+                                'http://b/2', 'http://a/3'] )
+        self.assertTrue( queue.empty() )
+
+    def test_host_queue_passes_over_limited_host(self):
+        limiter = cabinet.HostLimiter(rate=1, burst=1)
+        limiter.release(limiter.acquire('http://a/0'))
+        queue = cabinet.HostQueue(host=cabinet.url_host, limiter=limiter)
+        for url in ['http://a/1', 'http://b/1'] :
+            queue.put(url)
+        self.assertEqual( queue.get(), 'http://b/1' )
+
+    def test_get_web_page_waits_for_limiter(self):
+        adapter = FixtureAdapter({'http://fixture.test/a':u'<p>a</p>'})
+        cabinet.configure_session().mount('http://fixture.test/', adapter)
+        cabinet.configure_rate_limit(rate=20, burst=1)
+        try :
+            start = time.time()
+            for i in range(3) :
+                cabinet.get_web_page('http://fixture.test/a')
+            self.assertGreaterEqual( time.time() - start, 0.09 )
+        finally :
+            cabinet.configure_rate_limit(None, max_concurrency=None)
+            cabinet.configure_session()
+
+
+class TestRetries(unittest.TestCase):
+
+    def setUp(self):
+        cabinet.configure_retries(retries=2, backoff=0.001)
+        self.session = cabinet.configure_session()
+
+    def tearDown(self):
+        cabinet.configure_retries()
+        cabinet.configure_session()
+
+    def mount(self, failures):
+        adapter = FixtureAdapter({'http://fixture.test/a':u'<p>a</p>'}, failures=failures)
+        self.session.mount('http://fixture.test/', adapter)
+        return adapter
+
+    def test_retries_server_errors(self):
+        adapter = self.mount({'http://fixture.test/a':[(503, {}), (429, {})]})
+        res = cabinet.get_web_page('http://fixture.test/a')
+        self.assertEqual( res.text, u'<p>a</p>' )
+        self.assertEqual( len(adapter.requests), 3 )
+
+    def test_retries_connection_errors(self):
+        adapter = self.mount({'http://fixture.test/a':[requests.exceptions.ConnectionError('reset'),
+                                                       requests.exceptions.Timeout('timed out')]})
+        res = cabinet.get_web_page('http://fixture.test/a')
+        self.assertEqual( res.text, u'<p>a</p>' )
+
+    def test_gives_up_after_retries(self):
+        adapter = self.mount({'http://fixture.test/a':[(500, {})] * 3})
+        self.assertRaises(requests.exceptions.HTTPError, cabinet.get_web_page, 'http://fixture.test/a')
+        self.assertEqual( len(adapter.requests), 3 )
+
+    def test_does_not_retry_client_errors(self):
+        adapter = self.mount({'http://fixture.test/a':[(404, {})]})
+        self.assertRaises(requests.exceptions.HTTPError, cabinet.get_web_page, 'http://fixture.test/a')
+        self.assertEqual( len(adapter.requests), 1 )
+
+    def test_honours_retry_after(self):
+        adapter = self.mount({'http://fixture.test/a':[(503, {'Retry-After':'0'})]})
+        cabinet.configure_retries(retries=1, backoff=60)
+        start = time.time()
+        cabinet.get_web_page('http://fixture.test/a')
+        self.assertLess( time.time() - start, 5 )
+
+    def test_retry_delay(self):
+        self.assertEqual( cabinet.retry_delay(0, '7'), 7.0 )
+        self.assertEqual( cabinet.retry_delay(0, 'Thu, 01 Jan 1970 00:00:00 GMT'), 0 )
+        self.assertEqual( cabinet.retry_delay(0, '86400'), cabinet.RETRY_MAX_BACKOFF )
+        self.assertEqual( cabinet.retry_delay(0, 'Fri, 01 Jan 2100 00:00:00 GMT'),
+                          cabinet.RETRY_MAX_BACKOFF )
+        for attempt in range(5) :
+            delay = cabinet.retry_delay(attempt)
+            self.assertTrue( 0 <= delay <= 0.001 * 2 ** attempt )
+
 
 PRICE_CONTENTS_DATA = [ 
 u'''<p class="pricePerUnit">£3.50</p>''',
@@ -2948,5 +4051,22 @@ This information is supplied for your personal use only. It may not be reproduce
 <!-- END ProductDisplay.jsp -->
 '''
         
+pagedUrl = 'http://example.com/fruit/listing.html'
+pagedUrl2 = 'http://example.com/fruit/listing-2.html'
+pagedUrl3 = 'http://example.com/fruit/listing-3.html'
+loopUrl = 'http://example.com/fruit/loop.html'
+
+def with_next_link(html, href):
+    return html.replace('<li class="next">', '<li class="next"><a href="%s">' % href +
+                        'Go to next page</a>')
+
+# Three pages of listings joined by next page links, and a page that links to itself
+PAGED_LISTINGS = {
+    pagedUrl : with_next_link(TESTHTML, 'listing-2.html'),
+    pagedUrl2 : with_next_link(TESTHTML, '/fruit/listing-3.html'),
+    pagedUrl3 : TESTHTML,
+    loopUrl : with_next_link(TESTHTML, 'loop.html'),
+}
+
 if __name__ == '__main__' :
-    unittest.main()
\ No newline at end of file
+    unittest.main()